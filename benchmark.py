@@ -0,0 +1,715 @@
+import contextlib
+import datetime
+import heapq
+import html
+import io
+import json
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from parser import getopts, ComputeCoolStuff, ParseHTMLForData, ScanHTMLForData, TimestampDecoder, \
+    UnexpectedMarkup, ConversationWriter, parse_stream, parse_changed_files, CHUNK_SIZE, BATCH_SIZE, CODECS, COLUMNS, parse_file, load_all_saved_files, list_all_files, load_saved_file, saved_path, to_timestamp, \
+    query_server
+
+WORDS = ('ala ma kota jest bardzo fajnie dzisiaj jutro wczoraj się może już '
+         'żółć łódź gęś ćma hello world ok no tak nie wiem haha super').split()
+NAMES = ('Anna Nowak', 'Jan Kowalski', 'Ola Zielińska', 'Piotr Wiśniewski',
+         'Kasia Wójcik', 'Tomek Lewandowski', 'Ewa Kamińska', 'Marek Zając')
+
+
+def write_conversation(path, num_messages, participants=2, text_length=8, seed=0):
+    # Writes a conversation in the export format ParseHTMLForData expects,
+    # newest message first, without holding the whole file in memory
+    rng = random.Random(seed)
+    users = [NAMES[i % len(NAMES)] + ('' if i < len(NAMES) else ' {}'.format(i)) for i in range(participants)]
+    date = datetime.datetime(2018, 3, 1, 12, 0)
+    with open(path, 'w', encoding="utf8") as f:
+        f.write('<html><head><title>Conversation with {}</title></head><body>'.format(html.escape(users[-1])))
+        f.write('<div class="thread">Conversation with {}<br>Participants: {}'.format(
+            html.escape(users[-1]), html.escape(', '.join(users))))
+        for i in range(num_messages):
+            text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 2 * text_length)))
+            f.write('<div class="message"><div class="message_header"><span class="user">{}</span>'
+                    '<span class="meta">{} UTC+0{}</span></div></div><p>{}</p>'.format(
+                        html.escape(rng.choice(users)),
+                        date.strftime('%A, %d %B %Y at %H:%M'),
+                        1 + (date.month in (4, 5, 6, 7, 8, 9, 10)),
+                        html.escape(text)))
+            date -= datetime.timedelta(minutes=rng.choice((1, 1, 2, 3, 5, 15, 60, 240, 900)))
+        f.write('</div></body></html>')
+
+
+def write_archive(root, conversations, num_messages, participants=2, text_length=8, seed=0):
+    # An archive laid out like the export, ./messages/<n>.html with an empty ./saved;
+    # conversation sizes fall off like in real archives, the first one has num_messages
+    os.makedirs(os.path.join(root, 'messages'), exist_ok=True)
+    os.makedirs(os.path.join(root, 'saved'), exist_ok=True)
+    filenames = []
+    for i in range(conversations):
+        filenames.append('{}.html'.format(i))
+        write_conversation(os.path.join(root, 'messages', filenames[-1]), max(num_messages // (i + 1), 1),
+                           participants=participants if i % 4 else participants + i % 7, text_length=text_length,
+                           seed=seed + i)
+    return filenames
+
+
+def parse_with(parser_class, path, chunk_size):
+    parser = parser_class()
+    with open(path, 'r', encoding="utf8") as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            parser.feed(chunk)
+    parser.close()
+    return parser.conversationName, parser.msgs
+
+
+def diff_parsers(paths):
+    # The scanner with its HTMLParser fallback must give exactly what
+    # HTMLParser gives, however the file is split into chunks
+    failures = 0
+    for path in paths:
+        expected = parse_with(ParseHTMLForData, path, 1 << 30)
+        for chunk_size in (1 << 30, CHUNK_SIZE, 31):
+            try:
+                result = parse_with(ScanHTMLForData, path, chunk_size)
+                outcome = 'scanned'
+            except UnexpectedMarkup:
+                result = parse_with(ParseHTMLForData, path, chunk_size)
+                outcome = 'fallback'
+            if result != expected:
+                failures += 1
+                outcome = 'MISMATCH'
+            print('{:<40} chunk {:>10} {:>6} messages {}'.format(
+                os.path.basename(path)[:40], chunk_size, len(expected[1]), outcome))
+    print('{} mismatches'.format(failures))
+    return failures == 0
+
+
+def ingest_rss(sizes):
+    # Each ingest runs in a fresh interpreter so ru_maxrss is its own peak
+    script = ('import resource, parser; parser.parse_file("bench.html", verbose=False, force=True); '
+              'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)')
+    baseline = ('import resource, parser; '
+                'print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)')
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)), MPLBACKEND='Agg')
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(os.path.join(root, 'messages'))
+        os.makedirs(os.path.join(root, 'saved'))
+        base = int(subprocess.check_output([sys.executable, '-c', baseline], cwd=root, env=env))
+        print('{:>10} {:>10} {:>12} {:>12}'.format('Messages', 'File MB', 'Peak RSS MB', 'Over import'))
+        for size in sizes:
+            write_conversation(os.path.join(root, 'messages', 'bench.html'), size)
+            file_size = os.path.getsize(os.path.join(root, 'messages', 'bench.html'))
+            peak = int(subprocess.check_output([sys.executable, '-c', script], cwd=root, env=env))
+            print('{:>10,} {:>10.1f} {:>12.1f} {:>12.1f}'.format(
+                size, file_size / 1024 / 1024, peak / 1024, (peak - base) / 1024))
+
+
+def synthetic_analytics(num_messages, participants=2, text_length=8, seed=0):
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'bench.html')
+        write_conversation(path, num_messages, participants, text_length, seed)
+        parser = ParseHTMLForData()
+        with open(path, 'r', encoding="utf8") as f:
+            parser.feed(f.read())
+    with contextlib.redirect_stdout(io.StringIO()):
+        return ComputeCoolStuff({'name': parser.conversationName, 'messages': parser.msgs})
+
+
+def legacy_count_words(messages):
+    # getAllWords before the single-pass tokenizer, without the printing
+    min_length = 3
+    all_words = []
+    words_count = {}
+    for message in messages:
+        words = message['message'].split()
+        words = [w for w in words if len(w) > min_length]
+        words = [w.lower() for w in words]
+        words = [re.sub('[ ,.]','', w) for w in words]
+        for a, b in zip('ąęćóńżźśł', 'aeconzzsl'):
+            words = [re.sub(a, b, w) for w in words]
+        for word in words:
+            all_words.append(word)
+    for word in all_words:
+        if word in words_count:
+            words_count[word] += 1
+        else:
+            words_count[word] = 1
+    sorted_words = sorted(words_count.items(), key=lambda x:x[1])
+    return words_count, sorted_words[-15:]
+
+
+def topwords(num_messages):
+    analytics = synthetic_analytics(num_messages)
+    messages = list(analytics.messages)
+
+    start = time.perf_counter()
+    legacy, legacy_top = legacy_count_words(messages)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    counts = analytics.count_words()
+    top = heapq.nlargest(15, counts.items(), key=lambda x:x[1])
+    new_time = time.perf_counter() - start
+
+    # The same conversation saved with its text features, as ingest does
+    with tempfile.TemporaryDirectory() as root:
+        writer = ConversationWriter(os.path.join(root, 'bench_data'))
+        for i in range(0, len(messages), BATCH_SIZE):
+            writer.write_batch(messages[i:i + BATCH_SIZE])
+        writer.close(analytics.name)
+        saved = ComputeCoolStuff(load_saved_file(os.path.join(root, 'bench_data')), verbose=False)
+
+        start = time.perf_counter()
+        saved_counts = saved.count_words()
+        saved_time = time.perf_counter() - start
+
+    assert counts == legacy, 'word counts differ from the legacy implementation'
+    assert saved_counts == legacy, 'word counts of saved features differ from the legacy implementation'
+    assert sorted(x[1] for x in top) == [x[1] for x in legacy_top]
+    print('{:,} messages: legacy {:.3f}s, current {:.3f}s ({:.1f}x), from saved features {:.4f}s ({:.0f}x)'.format(
+        num_messages, legacy_time, new_time, legacy_time / new_time, saved_time, legacy_time / saved_time))
+
+
+class LegacyDecoder():
+    # handleNewMessage's strptime with a retry before TimestampDecoder
+    def decode(self, date):
+        try:
+            return datetime.datetime.strptime(date, '%A, %d %B %Y at %H:%M %Z')
+        except ValueError:
+            return datetime.datetime.strptime(date[:-3], '%A, %d %B %Y at %H:%M %Z')
+
+
+class LegacyRecords(ParseHTMLForData):
+    # handleNewMessage before Message records: a dict per message with its
+    # own copy of the user name
+    def handleNewMessage(self, date, user, message):
+        msg = {}
+        msg['user'] = ''.join(user)
+        msg['message'] = message
+        msg['date'] = self.decoder.decode(date)
+        self.msgs.append(msg)
+
+
+def retained_size(messages):
+    # Bytes of the list, its records and every distinct object they hold
+    seen = set()
+    size = sys.getsizeof(messages)
+    for message in messages:
+        size += sys.getsizeof(message)
+        for key in ('user', 'message', 'date'):
+            value = message[key]
+            if id(value) not in seen:
+                seen.add(id(value))
+                size += sys.getsizeof(value)
+    return size
+
+
+def records(num_messages):
+    # Memory held by the parsed messages of a conversation kept in memory
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'bench.html')
+        write_conversation(path, num_messages, participants=5)
+        sizes = {}
+        for name, parser_class in (('dict', LegacyRecords), ('Message', ParseHTMLForData)):
+            sizes[name] = retained_size(parse_with(parser_class, path, CHUNK_SIZE)[1])
+        for name, size in sizes.items():
+            print('{:<8} {:>10.1f} MB {:>8.1f} bytes per message'.format(name, size / 1024 / 1024, size / num_messages))
+        print('{:.1f} bytes per message saved'.format((sizes['dict'] - sizes['Message']) / num_messages))
+
+
+def timestamps(num_messages):
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'bench.html')
+        write_conversation(path, num_messages)
+
+        dates = []
+        parser = ParseHTMLForData(on_batch=lambda batch: None)
+        parser.decoder.decode = lambda date: dates.append(date)
+        with open(path, 'r', encoding="utf8") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                parser.feed(chunk)
+        parser.close()
+
+        results = {}
+        for name, decoder in (('legacy', LegacyDecoder), ('current', TimestampDecoder)):
+            start = time.perf_counter()
+            decoded = list(map(decoder().decode, dates))
+            decode_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            parser = ParseHTMLForData(on_batch=lambda batch: None, decoder=decoder())
+            with open(path, 'r', encoding="utf8") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                    parser.feed(chunk)
+            parser.close()
+            parse_time = time.perf_counter() - start
+
+            results[name] = decoded
+            print('{:<8} decode {:>12,.0f} dates/s, full parse {:>10,.0f} messages/s'.format(
+                name, len(dates) / decode_time, len(dates) / parse_time))
+        assert results['legacy'] == results['current'], 'decoded dates differ from strptime'
+
+
+def parse_throughput(num_messages):
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'bench.html')
+        write_conversation(path, num_messages)
+        for parser_class in (ParseHTMLForData, ScanHTMLForData):
+            start = time.perf_counter()
+            parse_with(partial(parser_class, on_batch=lambda batch: None), path, CHUNK_SIZE)
+            print('{:<18} {:>10,.0f} messages/s'.format(
+                parser_class.__name__, num_messages / (time.perf_counter() - start)))
+
+
+class SlowFile():
+    # A file on slow storage, every read takes as long as at bytes_per_second
+    def __init__(self, f, bytes_per_second):
+        self.f = f
+        self.bytesPerSecond = bytes_per_second
+
+    def read(self, size=-1):
+        chunk = self.f.read(size)
+        time.sleep(len(chunk) / self.bytesPerSecond)
+        return chunk
+
+    def seek(self, offset):
+        return self.f.seek(offset)
+
+    def tell(self):
+        return self.f.tell()
+
+
+def pipeline(num_messages, fast=False):
+    # Ingest throughput reading from storage of a given speed, one stage after
+    # another and with the threaded pipeline
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        os.chdir(root)
+        try:
+            os.makedirs('saved')
+            write_conversation('bench.html', num_messages)
+            size = os.path.getsize('bench.html')
+            print('{:>10} {:>14} {:>14} {:>32}'.format('MB/s', 'Sequential/s', 'Pipelined/s', 'Busy read / parse / write'))
+            for speed in (None, 50, 20, 10, 5):
+                results = []
+                for depth in (None, (4, 4)):
+                    stats = Counter()
+                    with open('bench.html', 'r', encoding="utf8") as f:
+                        start = time.perf_counter()
+                        writer, parser = parse_stream(SlowFile(f, speed * 1024 * 1024) if speed else f,
+                            'bench.html', fast=fast, depth=depth, stats=stats)
+                        writer.close(parser.conversationName)
+                        results.append(num_messages / (time.perf_counter() - start))
+                print('{:>10} {:>14,.0f} {:>14,.0f} {:>32}'.format(speed or 'local', results[0], results[1],
+                    ' / '.join('{:.0%}'.format(stats[stage] / stats['wall']) for stage in ('read', 'parse', 'write'))))
+        finally:
+            os.chdir(cwd)
+    print('{:.1f} MB file'.format(size / 1024 / 1024))
+
+
+def codecs(num_messages):
+    # Size, write time and load throughput of a saved conversation with every codec.
+    # Loading reads every column in full, which for mapped columns means from the page cache.
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'bench.html')
+        write_conversation(path, num_messages)
+        parser = ParseHTMLForData()
+        with open(path, 'r', encoding="utf8") as f:
+            parser.feed(f.read())
+
+        print('{:<6} {:>10} {:>8} {:>10} {:>12}'.format('Codec', 'MB', 'Ratio', 'Write s', 'Load MB/s'))
+        raw = None
+        for codec in [None] + list(CODECS):
+            saved = os.path.join(root, '{}_data'.format(codec))
+            start = time.perf_counter()
+            writer = ConversationWriter(saved, codec)
+            for i in range(0, len(parser.msgs), BATCH_SIZE):
+                writer.write_batch(parser.msgs[i:i + BATCH_SIZE])
+            writer.close(parser.conversationName)
+            write_time = time.perf_counter() - start
+            size = sum(entry.stat().st_size for entry in os.scandir(saved))
+            raw = raw or size
+
+            times = []
+            for _ in range(3):
+                start = time.perf_counter()
+                data = load_saved_file(saved)
+                columns = [data['messages'].dates, data['messages'].user_ids, data['messages'].offsets,
+                    data['messages'].text] + [data['messages'].features[column] for column, typecode in COLUMNS[4:]]
+                loaded = sum(len(bytes(column)) for column in columns)
+                times.append(time.perf_counter() - start)
+            print('{:<6} {:>10.2f} {:>7.2f}x {:>10.3f} {:>12,.0f}'.format(
+                codec or 'none', size / 1024 / 1024, raw / size, write_time, loaded / 1024 / 1024 / min(times)))
+
+
+def pushdown(num_messages, fraction=0.1):
+    # Load and analytics time of the newest fraction of a conversation against all of it,
+    # filtered when loading with every codec
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'bench.html')
+        write_conversation(path, num_messages, participants=4)
+        parser = ParseHTMLForData()
+        with open(path, 'r', encoding="utf8") as f:
+            parser.feed(f.read())
+        dates = sorted(to_timestamp(message['date']) for message in parser.msgs)
+        start = dates[int(len(dates) * (1 - fraction))]
+
+        print('{:<6} {:>10} {:>10} {:>10} {:>9}'.format('Codec', 'Messages', 'All s', 'Newest s', 'Speedup'))
+        for codec in [None] + list(CODECS):
+            saved = os.path.join(root, '{}_data'.format(codec))
+            writer = ConversationWriter(saved, codec)
+            for i in range(0, len(parser.msgs), BATCH_SIZE):
+                writer.write_batch(parser.msgs[i:i + BATCH_SIZE])
+            writer.close(parser.conversationName)
+
+            times = {}
+            for window in (None, start):
+                best = None
+                for _ in range(3):
+                    begin = time.perf_counter()
+                    analytics = ComputeCoolStuff(load_saved_file(saved, window), verbose=False)
+                    analytics.get_num_of_messages_by_user()
+                    analytics.get_words_by_user()
+                    analytics.top_words(15)
+                    analytics.get_breaks()
+                    elapsed = time.perf_counter() - begin
+                    best = elapsed if best is None else min(best, elapsed)
+                times[window] = (best, analytics.totalMessages)
+            print('{:<6} {:>10,} {:>10.3f} {:>10.3f} {:>8.1f}x'.format(codec or 'none', times[start][1],
+                times[None][0], times[start][0], times[None][0] / times[start][0]))
+
+
+# Queries a dashboard sends to -serve, on every conversation of the archive
+SERVER_QUERIES = ({'query': 'stats'}, {'query': 'wordstats'}, {'query': 'topwords', 'n': 15},
+    {'query': 'breaks'}, {'query': 'week'}, {'query': 'user_week'})
+
+
+def server(num_messages, clients=8, rounds=20):
+    # Latency of the first and of repeated queries to -serve, and their
+    # throughput with concurrent clients, against loading for every query
+    with tempfile.TemporaryDirectory() as root:
+        filenames = write_archive(root, 4, num_messages)
+        cwd = os.getcwd()
+        os.chdir(root)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                parse_changed_files(filenames, fast=True)
+            requests = [dict(request, conversation=filename) for filename in filenames for request in SERVER_QUERIES]
+
+            start = time.perf_counter()
+            for request in requests:
+                analytics = ComputeCoolStuff(load_saved_file(saved_path(request['conversation'])), verbose=False)
+                if request['query'] == 'topwords':
+                    analytics.top_words(15)
+                else:
+                    {'stats': analytics.get_num_of_messages_by_user, 'wordstats': analytics.get_words_by_user,
+                     'breaks': analytics.get_breaks, 'week': analytics.messagesByWeek,
+                     'user_week': analytics.getMessagesByUserByWeek}[request['query']]()
+            uncached = (time.perf_counter() - start) / len(requests)
+        finally:
+            os.chdir(cwd)
+
+        start = time.perf_counter()
+        for filename in filenames:
+            subprocess.run([sys.executable, PARSER, '-load', filename, '-stats'], cwd=root, check=True,
+                           stdout=subprocess.DEVNULL, env=dict(os.environ, MPLBACKEND='Agg'))
+        command = (time.perf_counter() - start) / len(filenames)
+
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        process = subprocess.Popen([sys.executable, PARSER, '-serve', str(port)], cwd=root, stdout=subprocess.DEVNULL)
+        try:
+            while True:
+                try:
+                    socket.create_connection(('127.0.0.1', port)).close()
+                    break
+                except ConnectionRefusedError:
+                    time.sleep(0.05)
+
+            start = time.perf_counter()
+            for request in requests:
+                query_server(request, port)
+            first = (time.perf_counter() - start) / len(requests)
+
+            start = time.perf_counter()
+            for request in requests * rounds:
+                query_server(request, port)
+            warm = (time.perf_counter() - start) / len(requests) / rounds
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(clients) as pool:
+                list(pool.map(partial(query_server, port=port), requests * rounds))
+            throughput = len(requests) * rounds / (time.perf_counter() - start)
+        finally:
+            process.terminate()
+            process.wait()
+
+        print('Command line run:          {:>8.2f} ms'.format(command * 1000))
+        print('Loading for every query:   {:>8.2f} ms'.format(uncached * 1000))
+        print('First query of the server: {:>8.2f} ms'.format(first * 1000))
+        print('Cached query:              {:>8.2f} ms'.format(warm * 1000))
+        print('{} concurrent clients:      {:>8,.0f} queries/s'.format(clients, throughput))
+
+
+# Algorithms of ComputeCoolStuff timed by the suite, each on a fresh instance
+# so cached columns are not shared between them
+ALGORITHMS = (
+    ('breaks', lambda analytics: analytics.compute_breaks()),
+    ('wordstats', lambda analytics: analytics.compute_total_words_by_user()),
+    ('topwords', lambda analytics: analytics.getAllWords(15)),
+    ('stats', lambda analytics: analytics.printUserStats()),
+    ('activity', lambda analytics: analytics.get_messages_every_5_minutes(10)),
+    ('by_week', lambda analytics: analytics.messagesByWeek()),
+    ('by_user_by_week', lambda analytics: analytics.getMessagesByUserByWeek()),
+    ('by_user_by_day', lambda analytics: analytics.getMessagesByUserByDay()),
+)
+
+
+def measure(func, repeat=3):
+    # Best of repeat runs for time, then one more run under tracemalloc for the
+    # peak of Python and NumPy allocations, which tracemalloc would slow down
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(times), 'mean_seconds': sum(times) / len(times), 'peak_bytes': peak}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+PARSER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'parser.py')
+
+# Commands timed from start to exit, from ones that only read the catalog
+# to one that loads a conversation and runs an algorithm
+STARTUP_COMMANDS = (('-h',), ('-list',), ('-files',), ('-search', 'kota'), ('-load', '0.html', '-stats'))
+
+
+def startup_times(root, repeat=5):
+    # Best and mean wall time of a fresh interpreter running each command in root
+    env = dict(os.environ, MPLBACKEND='Agg')
+    stages = {}
+    for command in STARTUP_COMMANDS:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, PARSER] + list(command), cwd=root, env=env, check=True,
+                           stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        stages['startup ' + ' '.join(command)] = {
+            'seconds': min(times),
+            'mean_seconds': sum(times) / len(times),
+            'peak_bytes': None,
+        }
+    return stages
+
+
+def import_times(root, command=('-h',)):
+    # Cumulative microseconds of every module parser.py imports itself, from -X importtime
+    output = subprocess.run([sys.executable, '-X', 'importtime', PARSER] + list(command), cwd=root,
+                            env=dict(os.environ, MPLBACKEND='Agg'), check=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True).stderr
+    modules = []
+    for line in output.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)', line)
+        if match and not match.group(3):
+            modules.append((int(match.group(2)), match.group(4)))
+    return sorted(modules, reverse=True)
+
+
+def startup(repeat=5):
+    with tempfile.TemporaryDirectory() as root:
+        filenames = write_archive(root, 3, 2000)
+        cwd = os.getcwd()
+        os.chdir(root)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                parse_changed_files(filenames)
+        finally:
+            os.chdir(cwd)
+
+        print('{:<28} {:>10} {:>10}'.format('Command', 'Best s', 'Mean s'))
+        for stage, result in startup_times(root, repeat).items():
+            print('{:<28} {:>10.3f} {:>10.3f}'.format(stage[8:], result['seconds'], result['mean_seconds']))
+
+        modules = import_times(root)
+        print('\nTop-level imports of parser.py -h, {:.1f} ms in all:'.format(sum(x[0] for x in modules) / 1000))
+        for microseconds, module in modules[:10]:
+            print('{:<28} {:>8.1f} ms'.format(module, microseconds / 1000))
+
+
+def run_suite(conversations=20, num_messages=50000, participants=2, text_length=8, seed=0, repeat=3):
+    # parser works on ./messages and ./saved, so the suite runs from the archive root
+    results = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'params': {
+            'conversations': conversations,
+            'messages': num_messages,
+            'participants': participants,
+            'text_length': text_length,
+            'seed': seed,
+            'repeat': repeat,
+        },
+        'stages': {},
+    }
+    stages = results['stages']
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as root:
+        filenames = write_archive(root, conversations, num_messages, participants, text_length, seed)
+        os.chdir(root)
+        try:
+            results['archive_bytes'] = sum(os.path.getsize(os.path.join('messages', x)) for x in filenames)
+            stages['parse_file'] = measure(lambda: [parse_file(x, verbose=False, force=True) for x in filenames], repeat)
+            stages['parse_file_fast'] = measure(
+                lambda: [parse_file(x, verbose=False, force=True, fast=True) for x in filenames], repeat)
+            stages['load_all_saved_files'] = measure(load_all_saved_files, repeat)
+            stages['list_all_files'] = measure(list_all_files, repeat)
+
+            data = load_saved_file(saved_path(filenames[0]))
+            for name, algorithm in ALGORITHMS:
+                stages[name] = measure(lambda: algorithm(ComputeCoolStuff(data, verbose=False)), repeat)
+
+            # Startup of the command line, with the catalog and manifest of an ingested archive
+            with contextlib.redirect_stdout(io.StringIO()):
+                parse_changed_files(filenames, fast=True)
+            stages.update(startup_times(root, repeat))
+        finally:
+            os.chdir(cwd)
+    return results
+
+
+def print_suite(results, baseline=None):
+    print('{:<22} {:>10} {:>12} {:>10} {:>10}'.format('Stage', 'Seconds', 'Peak MB', 'Time', 'Memory'))
+    for stage, result in results['stages'].items():
+        peak = result['peak_bytes']
+        line = '{:<22} {:>10.4f} {:>12}'.format(stage, result['seconds'], '' if peak is None else '{:.2f}'.format(peak / 1024 / 1024))
+        previous = (baseline or {}).get('stages', {}).get(stage)
+        if previous:
+            line += ' {:>9.2f}x {:>10}'.format(result['seconds'] / previous['seconds'],
+                '' if peak is None else '{:.2f}x'.format(peak / max(previous['peak_bytes'], 1)))
+        print(line)
+
+
+if __name__ == "__main__":
+    args = getopts(sys.argv)
+
+    if '-h' in args:
+        print('\nusage: [-rss [<sizes>]] peak RSS of parse_file against file size,')
+        print('                         sizes is a comma separated list of message counts')
+        print('       [-topwords [<messages>]] word counting against the legacy tokenizer')
+        print('       [-timestamps [<messages>]] date decoding and parse throughput against strptime')
+        print('       [-diff [<dir>]] check the fast scanner gives the same messages as HTMLParser on')
+        print('                       the .html files in dir (./messages)')
+        print('       [-scan [<messages>]] parse throughput of HTMLParser and the fast scanner')
+        print('       [-pipeline [<messages>]] ingest throughput from slow storage with and without the')
+        print('                                pipeline, optionally with [-fast]')
+        print('       [-records [<messages>]] memory of parsed messages as dicts and as Message records')
+        print('       [-codecs [<messages>]] saved size, write time and load throughput of every codec')
+        print('       [-pushdown <n>] load and analytics time of the newest tenth of n messages, filtered when loading')
+        print('       [-server <n>] latency of -serve queries on 4 conversations of up to n messages, first and cached,')
+        print('                 and throughput with [-clients <n>] (8) concurrent clients')
+        print('       [-startup] wall time of quick commands and import times of parser.py')
+        print('       [-generate <dir>] write a synthetic archive to dir')
+        print('       [-suite] time and peak memory of parsing, loading, listing and every algorithm')
+        print('                on a synthetic archive, written as JSON to [-out <file>]')
+        print('       [-baseline <file>] compare the results of -suite against the JSON of an earlier run')
+        print('       Synthetic archives: [-conversations <n>] [-messages <n>] of the largest conversation,')
+        print('                           [-participants <n>] [-length <words>] [-seed <n>] [-repeat <n>]')
+
+    if '-rss' in args:
+        sizes = args['-rss']
+        if sizes is True:
+            sizes = '10000,100000,1000000'
+        ingest_rss([int(x) for x in sizes.split(',')])
+
+    if '-topwords' in args:
+        size = args['-topwords']
+        topwords(100000 if size is True else int(size))
+
+    if '-timestamps' in args:
+        size = args['-timestamps']
+        timestamps(1000000 if size is True else int(size))
+
+    if '-diff' in args:
+        # Edge cases and synthetic conversations are checked by tests/test_scanner.py
+        directory = './messages' if args['-diff'] is True else args['-diff']
+        paths = [os.path.join(directory, x) for x in sorted(os.listdir(directory)) if x.endswith('.html')]
+        if not diff_parsers(paths):
+            sys.exit(1)
+
+    if '-scan' in args:
+        size = args['-scan']
+        parse_throughput(100000 if size is True else int(size))
+
+    if '-startup' in args:
+        startup(int(args.get('-repeat', 5)))
+
+    if '-pipeline' in args:
+        size = args['-pipeline']
+        pipeline(100000 if size is True else int(size), '-fast' in args)
+
+    if '-records' in args:
+        size = args['-records']
+        records(1000000 if size is True else int(size))
+
+    if '-pushdown' in args:
+        pushdown(int(args['-pushdown']))
+
+    if '-server' in args:
+        server(int(args['-server']), int(args.get('-clients', 8)))
+
+    if '-codecs' in args:
+        size = args['-codecs']
+        codecs(200000 if size is True else int(size))
+
+    params = {
+        'conversations': int(args.get('-conversations', 20)),
+        'num_messages': int(args.get('-messages', 50000)),
+        'participants': int(args.get('-participants', 2)),
+        'text_length': int(args.get('-length', 8)),
+        'seed': int(args.get('-seed', 0)),
+    }
+
+    if '-generate' in args:
+        root = './synthetic' if args['-generate'] is True else args['-generate']
+        filenames = write_archive(root, **params)
+        print('Wrote {} conversations to {}'.format(len(filenames), os.path.join(root, 'messages')))
+
+    if '-suite' in args:
+        results = run_suite(repeat=int(args.get('-repeat', 3)), **params)
+        baseline = None
+        if '-baseline' in args:
+            with open(args['-baseline'], 'r', encoding="utf8") as f:
+                baseline = json.load(f)
+        print_suite(results, baseline)
+        if '-out' in args:
+            with open(args['-out'], 'w', encoding="utf8") as f:
+                json.dump(results, f, indent=2)
@@ -3,21 +3,578 @@ import pickle
 import os.path
 from os import listdir, walk
 import sys
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
+from functools import partial, cached_property, lru_cache, wraps
+from contextlib import contextmanager
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import accumulate, groupby
+from operator import itemgetter
+import heapq
+from multiprocessing import Pool
 import re
 import datetime
-
-def parse_all_files():
+import html
+import json
+import hashlib
+import io
+import mmap
+import shutil
+import sqlite3
+import socket
+import time
+import fnmatch
+import queue
+import threading
+import atexit
+import tracemalloc
+import math
+import zlib
+import lzma
+from array import array
+from importlib import import_module
+
+
+class LazyModule():
+    # Stands in for a module until its first use imports it, after which the
+    # module replaces it under its global name. Listing, finding, searching
+    # and parsing never pay for importing NumPy or matplotlib.
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+
+    def __getattr__(self, attribute):
+        module = import_module(self.module)
+        globals()[self.name] = module
+        return getattr(module, attribute)
+
+
+np = LazyModule('numpy', 'np')
+plt = LazyModule('matplotlib.pyplot', 'plt')
+mdates = LazyModule('matplotlib.dates', 'mdates')
+
+# Files are fed to the parsers in chunks of this many characters and parsed
+# messages are written out in batches, so memory does not grow with file size
+CHUNK_SIZE = 1 << 16
+BATCH_SIZE = 10000
+HEADER_SIZE = 1 << 12
+
+# The ingest pipeline reads this many characters at a time. Few large reads
+# keep the reader thread from waiting on the GIL after every one.
+PIPELINE_READ_SIZE = 1 << 20
+
+# Saved timestamps are seconds since this date, in the export's local time
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Message counts by user saved with every conversation
+ROLLUPS = ('day', 'week', 'minute')
+
+# Columns of a saved conversation and their array typecodes. Those always
+# growing, or shrinking for dates saved newest first, are compressed as
+# differences between neighbours.
+COLUMNS = (('dates', 'q'), ('users', 'H'), ('offsets', 'q'), ('text', None),
+    ('words', 'I'), ('letters', 'I'), ('tokens', 'I'), ('token_offsets', 'q'))
+DELTA_COLUMNS = ('dates', 'offsets', 'token_offsets')
+
+# Codecs of -compress: file suffix, compressor factory and decompress. Columns
+# are compressed this many bytes at a time (a multiple of 8 for the deltas).
+CODECS = {
+    'fast': ('.z', lambda: zlib.compressobj(1), zlib.decompress),
+    'high': ('.xz', lambda: lzma.LZMACompressor(preset=6), lzma.decompress),
+}
+COMPRESS_BLOCK = 1 << 20
+# Codec used without -compress: a conversation saved again keeps the codec
+# it was stored with, new ones are saved uncompressed
+KEEP_CODEC = 'keep'
+
+# Saved conversations are split into partitions of this many messages. The
+# range of their dates and their users are kept in meta.json, so -from, -to
+# and -user only read partitions that can hold matching messages, and every
+# partition of a compressed column is its own frame.
+PARTITION_SIZE = 1 << 16
+
+# Messages per step of the session pass, bounding its temporary arrays
+PASS_SIZE = 1 << 20
+
+# Characters not counted as letters by -wordstats
+NOT_LETTERS = ' ,.:;'
+
+# Words of -topwords are longer than this, folded by WORD_TABLE
+MIN_WORD_LENGTH = 3
+
+# Folds Polish letters to ASCII and strips punctuation from lowercased words
+WORD_TABLE = str.maketrans('ąęćóńżźśł', 'aeconzzsl', ' ,.')
+FOLD_TABLE = str.maketrans('ąęćóńżźśł', 'aeconzzsl')
+
+# -serve listens on this local port with a pool of this many threads for
+# clients, and keeps conversations and results up to this many megabytes
+SERVE_PORT = 8765
+SERVE_THREADS = 16
+SERVE_CACHE_MB = 512
+
+# Set by -profile, see start_profiler
+profiler = None
+
+def parse_all_files(workers=1, fast=False, codec=KEEP_CODEC, depth=None):
     files = []
     for (dirpath, dirnames, filenames) in walk('{}'.format('./messages')):
         files.extend(filenames)
-        for filename in files:
-            parse_file(filename)
         break
+
+    # Drop saved data of conversations that are no longer in the archive,
+    # except those -merge consolidated from other exports
+    manifest = load_manifest()
+    removed = [filename for filename in manifest if filename not in files and 'merged' not in manifest[filename]]
+    for filename in removed:
+        if os.path.isdir(saved_path(filename)):
+            shutil.rmtree(saved_path(filename))
+        del manifest[filename]
+        print('Removed {}'.format(filename))
+    save_manifest(manifest)
+    update_catalog(removed)
+    update_search_index(removed)
+
+    parse_changed_files(files, workers, fast, codec, depth)
     print("Done.")
 
 
+def parse_changed_files(files, workers=1, fast=False, codec=KEEP_CODEC, depth=None):
+    manifest = load_manifest()
+    changed = find_changed_files(files, manifest)
+    if len(changed) < len(files):
+        print('{} of {} files unchanged, skipping'.format(len(files) - len(changed), len(files)))
+
+    parsed = []
+    stats = Counter()
+    os.makedirs('./saved', exist_ok=True)
+    index = open_search_index()
+    try:
+        if workers > 1:
+            # Largest files first so a single huge conversation does not finish last
+            changed.sort(key=lambda x:os.path.getsize('{}/{}'.format('./messages', x)), reverse=True)
+            with Pool(workers, *worker_profiler_args()) as pool:
+                done = pool.imap_unordered(partial(ingest_file, verbose=False, fast=fast, codec=codec, depth=depth), changed)
+                for i, (filename, entry, terms, events, pipeline) in enumerate(done, 1):
+                    stats.update(pipeline)
+                    if profiler is not None:
+                        profiler.events.extend(events)
+                    manifest[filename] = entry
+                    parsed.append(filename)
+                    update_search_index([filename], index, {filename: terms})
+                    print('[{}/{}] Parsed {}'.format(i, len(changed), filename))
+        else:
+            for filename in changed:
+                filename, entry, terms, events, pipeline = ingest_file(filename, fast=fast, codec=codec, depth=depth)
+                stats.update(pipeline)
+                manifest[filename] = entry
+                parsed.append(filename)
+                update_search_index([filename], index, {filename: terms})
+    finally:
+        index.close()
+        save_manifest(manifest)
+        update_catalog(parsed)
+    if depth:
+        print_pipeline_stats(stats, len(parsed))
+
+
+def ingest_file(filename, verbose=True, fast=False, codec=KEEP_CODEC, depth=None):
+    # Describe the source before parsing so a write during parsing is picked
+    # up next run; it is hashed as it is parsed rather than read twice
+    entry = manifest_entry(filename, with_hash=False)
+    digest = hashlib.blake2b(digest_size=16)
+    pipeline = Counter()
+    parse_file(filename, verbose=verbose, force=True, fast=fast, codec=codec, depth=depth, stats=pipeline, digest=digest)
+    entry['hash'] = digest.hexdigest()
+    # Search terms are gathered here so -j tokenizes in the workers and the
+    # parent only inserts them
+    terms = message_terms(filename)
+    # Workers hand their profile and pipeline times back with the result
+    events = profiler.collect() if profiler is not None else []
+    return filename, entry, terms, events, pipeline
+
+
+def merge_archives(roots, workers=1, fast=False, codec=KEEP_CODEC):
+    # Consolidates the conversations of several, possibly overlapping exports.
+    # Every file is parsed to a temporary store first, then each conversation
+    # (same file name in every export) is merged into one store.
+    tmp = './saved/merge.tmp'
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    tasks = []
+    for i, root in enumerate(roots):
+        directory = os.path.join(root, 'messages') if os.path.isdir(os.path.join(root, 'messages')) else root
+        for filename in sorted(listdir(directory)):
+            if filename.endswith('.html'):
+                tasks.append((os.path.join(directory, filename), os.path.join(tmp, str(i), filename[:-5] + '_data'), fast))
+    print('Parsing {} files of {} archives...'.format(len(tasks), len(roots)))
+    if workers > 1:
+        with Pool(workers, *worker_profiler_args()) as pool:
+            for i, (path, events) in enumerate(pool.imap_unordered(parse_archive_file, tasks), 1):
+                if profiler is not None:
+                    profiler.events.extend(events)
+                print('[{}/{}] Parsed {}'.format(i, len(tasks), path))
+    else:
+        for task in tasks:
+            parse_archive_file(task)
+
+    conversations = {}
+    for task in tasks:
+        conversations.setdefault(os.path.basename(task[0]), []).append(task[1])
+    merged = []
+    total = Counter()
+    try:
+        for filename, paths in sorted(conversations.items()):
+            total.update(merge_conversation(filename, [load_saved_file(path) for path in paths], codec,
+                [np.fromfile(os.path.join(path, 'zones.bin'), dtype=np.int16) for path in paths]))
+            merged.append(filename)
+    finally:
+        shutil.rmtree(tmp)
+        # Recorded so -A and -load leave the merged stores alone
+        manifest = load_manifest()
+        for filename in merged:
+            manifest[filename] = {'merged': roots}
+        save_manifest(manifest)
+        update_catalog(merged)
+        update_search_index(merged)
+    print('Merged {} conversations: {:,} messages read, {:,} duplicates dropped, {:,} kept'.format(
+        len(merged), total['read'], total['read'] - total['kept'], total['kept']))
+
+
+def parse_archive_file(task):
+    # The UTC offsets of the messages are saved next to their columns
+    source, path, fast = task
+    with open(source, 'r', encoding="utf8") as f:
+        writer, parser = parse_stream(f, os.path.basename(source), fast, path=path, zones=True)
+        writer.close(parser.conversationName)
+    with open(os.path.join(path, 'zones.bin'), 'wb') as fp:
+        fp.write(parser.decoder.zones.tobytes())
+    return source, profiler.collect() if profiler is not None else []
+
+
+def date_order(dates):
+    # -1 if the dates never increase, as in exports, which are newest first,
+    # 1 if they never decrease and 0 if they have to be sorted
+    if len(dates) < 2 or np.all(dates[1:] <= dates[:-1]):
+        return -1
+    if np.all(dates[1:] >= dates[:-1]):
+        return 1
+    return 0
+
+
+def newest_first(dates, source=None):
+    # (date, source, row) of dates (an array) newest first, in steps of PASS_SIZE
+    # so the dates and rows of a whole conversation are never lists at once
+    order = date_order(dates)
+    if order < 0:
+        order = np.arange(len(dates))
+    elif order > 0:
+        order = np.arange(len(dates))[::-1]
+    else:
+        order = np.argsort(-dates, kind='stable')
+    for start in range(0, len(order), PASS_SIZE):
+        rows = order[start:start + PASS_SIZE]
+        for date, row in zip(dates[rows].tolist(), rows.tolist()):
+            yield date, source, row
+
+
+def merge_conversation(filename, sources, codec=KEEP_CODEC, zones=None):
+    # Merges exports of a conversation newest first. Messages sent the same
+    # minute are deduplicated by user and a hash of their text; a message
+    # is kept as many times as the export having it the most times has it,
+    # so messages really sent twice stay twice. Linear in messages, with
+    # memory bounded by the messages of a single minute. zones are the UTC
+    # offsets in minutes of every source's messages: minutes are compared
+    # in UTC, so exports made in different time zones match, and messages
+    # are kept in the local time of the export they are taken from.
+    local = [np.frombuffer(data['messages'].dates, dtype=np.int64) for data in sources]
+    offsets = [zone.astype(np.int64) * 60 for zone in zones] if zones else [0] * len(sources)
+    streams = [newest_first(dates - offset, source) for source, (dates, offset) in enumerate(zip(local, offsets))]
+    # The newest export names the conversation
+    name = max(sources, key=lambda data: np.frombuffer(data['messages'].dates, dtype=np.int64).max(initial=0))['name']
+
+    writer = ConversationWriter(saved_path(filename), codec)
+    batch = []
+    counts = Counter()
+    try:
+        for date, group in groupby(heapq.merge(*streams, key=lambda x: -x[0]), key=itemgetter(0)):
+            kept = Counter()
+            seen = Counter()
+            for date, source, row in group:
+                messages = sources[source]['messages']
+                text = messages.text[messages.offsets[row]:messages.offsets[row + 1]]
+                key = (messages.users[messages.user_ids[row]], hashlib.blake2b(text, digest_size=8).digest())
+                seen[(source, key)] += 1
+                counts['read'] += 1
+                if seen[(source, key)] > kept[key]:
+                    kept[key] += 1
+                    batch.append(Message(key[0], text.decode('utf8'), from_timestamp(int(local[source][row]))))
+                    if len(batch) >= BATCH_SIZE:
+                        writer.write_batch(batch)
+                        batch = []
+            counts['kept'] += sum(kept.values())
+        writer.write_batch(batch)
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close(name)
+    return counts
+
+
+def saved_path(filename):
+    return "./saved/{}_data".format(filename[:-5])
+
+
+def load_manifest():
+    return load_json('./saved/manifest.json')
+
+
+def save_manifest(manifest):
+    save_json('./saved/manifest.json', manifest)
+
+
+def load_catalog():
+    if not os.path.isfile('./saved/catalog.json'):
+        return rebuild_catalog()
+    return load_json('./saved/catalog.json')
+
+
+def rebuild_catalog():
+    catalog = {}
+    for (dirpath, dirnames, filenames) in walk('{}'.format('./saved')):
+        for dirname in dirnames:
+            if dirname.endswith('_data'):
+                catalog[dirname[:-5] + '.html'] = catalog_entry("./saved/{}".format(dirname))
+        break
+    save_json('./saved/catalog.json', catalog)
+    return catalog
+
+
+def update_catalog(filenames):
+    # Called by the process that saved the conversations, so workers never
+    # write the catalog concurrently
+    catalog = load_catalog()
+    for filename in filenames:
+        if os.path.isdir(saved_path(filename)):
+            catalog[filename] = catalog_entry(saved_path(filename))
+        else:
+            catalog.pop(filename, None)
+    save_json('./saved/catalog.json', catalog)
+
+
+def catalog_entry(path):
+    meta = load_json(os.path.join(path, 'meta.json'))
+    return {
+        'name': meta['name'],
+        'messages': meta['messages'],
+        'users': meta['users'],
+        'first': meta.get('first'),
+        'last': meta.get('last'),
+        'bytes': sum(entry.stat().st_size for entry in os.scandir(path)),
+    }
+
+
+def open_search_index():
+    index = sqlite3.connect('./saved/search.db')
+    index.execute('CREATE TABLE IF NOT EXISTS conversations (id INTEGER PRIMARY KEY, filename TEXT UNIQUE NOT NULL)')
+    index.execute('CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, conversation INTEGER NOT NULL, '
+        'message INTEGER NOT NULL, PRIMARY KEY (term, conversation, message)) WITHOUT ROWID')
+    # Lets a conversation's postings be dropped without scanning the table
+    index.execute('CREATE INDEX IF NOT EXISTS postings_by_conversation ON postings (conversation)')
+    return index
+
+
+def message_terms(filename):
+    # Offsets of the saved messages containing each search term, built where
+    # the conversation was parsed so -j workers share the tokenizing
+    terms = {}
+    messages = load_saved_file(saved_path(filename))['messages']
+    for i in range(len(messages)):
+        for term in set(search_terms(messages.get_text(i))):
+            terms.setdefault(term, array('I')).append(i)
+    return terms
+
+
+def update_search_index(filenames, index=None, terms=None):
+    # Like the catalog, only written by the process that saved the conversations.
+    # terms maps file names to their message_terms when already computed.
+    os.makedirs('./saved', exist_ok=True)
+    index = index or open_search_index()
+    terms = terms or {}
+    with index:
+        for filename in filenames:
+            added = index.execute('INSERT OR IGNORE INTO conversations (filename) VALUES (?)', (filename,)).rowcount
+            conversation = index.execute('SELECT id FROM conversations WHERE filename = ?', (filename,)).fetchone()[0]
+            if not added:
+                index.execute('DELETE FROM postings WHERE conversation = ?', (conversation,))
+            if not os.path.isdir(saved_path(filename)):
+                index.execute('DELETE FROM conversations WHERE id = ?', (conversation,))
+                continue
+
+            found = terms[filename] if filename in terms else message_terms(filename)
+            index.executemany('INSERT INTO postings VALUES (?, ?, ?)',
+                ((term, conversation, i) for term in sorted(found) for i in found[term]))
+
+
+def search_terms(text):
+    return re.findall(r'\w+', text.lower().translate(FOLD_TABLE))
+
+
+def search_messages(query, user=None, start=None, end=None, limit=50):
+    terms = set(search_terms(query))
+    if not terms:
+        return []
+
+    catalog = load_catalog()
+    index = open_search_index()
+    indexed = set(x[0] for x in index.execute('SELECT filename FROM conversations'))
+    missing = [filename for filename in catalog if filename not in indexed]
+    if missing:
+        print('Indexing {} conversations...'.format(len(missing)))
+        update_search_index(missing, index)
+
+    # Conversation and message offset of messages containing all the terms
+    query = ' INTERSECT '.join(['SELECT conversation, message FROM postings WHERE term = ?'] * len(terms))
+    found = {}
+    for conversation, message in index.execute(query, list(terms)):
+        found.setdefault(conversation, []).append(message)
+    filenames = dict(index.execute('SELECT id, filename FROM conversations'))
+    index.close()
+
+    # Filtered and ranked on the date column, only the kept messages are decoded
+    matches = []
+    stores = {}
+    for conversation, offsets in found.items():
+        filename = filenames[conversation]
+        messages = stores[filename] = load_saved_file(saved_path(filename))['messages']
+        user_ids = set(i for i, name in enumerate(messages.users) if user is None or name.startswith(user))
+        for i in offsets:
+            date = messages.dates[i]
+            if messages.user_ids[i] not in user_ids:
+                continue
+            if (start is not None and date < start) or (end is not None and date >= end):
+                continue
+            matches.append((date, filename, i))
+
+    results = []
+    for date, filename, i in heapq.nlargest(limit, matches):
+        messages = stores[filename]
+        results.append({
+            'conversation': catalog[filename]['name'],
+            'filename': filename,
+            'user': messages.users[messages.user_ids[i]],
+            'message': messages.get_text(i),
+            'date': from_timestamp(date),
+        })
+    return results
+
+
+def print_search_results(results):
+    for result in results:
+        print('{} {:<20} {:<18} {}'.format(
+            result['date'], result['conversation'][:19], result['user'][:17], result['message']))
+    print('{} messages found'.format(len(results)))
+
+
+def parse_date(text):
+    return to_timestamp(datetime.datetime.strptime(text, '%Y-%m-%d'))
+
+
+def load_json(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path, 'r', encoding="utf8") as fp:
+        return json.load(fp)
+
+
+def save_json(path, data):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding="utf8") as fp:
+        json.dump(data, fp, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def manifest_entry(filename, with_hash=True):
+    path = '{}/{}'.format('./messages', filename)
+    stat = os.stat(path)
+    entry = {
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+    }
+    if with_hash:
+        entry['hash'] = hash_file(path)
+    return entry
+
+
+def hash_file(path):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class HashingReader(io.RawIOBase):
+    # Binary file adding every byte read to a digest, for parsing and hashing
+    # a file in one read. A file read again from the start, as when the
+    # scanner falls back to HTMLParser, is only hashed the first time.
+    def __init__(self, path, digest):
+        self.f = open(path, 'rb')
+        self.digest = digest
+        self.hashed = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        start = self.f.tell()
+        size = self.f.readinto(buffer)
+        if start + size > self.hashed:
+            self.digest.update(memoryview(buffer)[max(self.hashed - start, 0):size])
+            self.hashed = start + size
+        return size
+
+    def tell(self):
+        return self.f.tell()
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if offset != 0 or whence != os.SEEK_SET:
+            raise io.UnsupportedOperation('can only seek back to the start')
+        return self.f.seek(0)
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+def find_changed_files(files, manifest):
+    changed = []
+    for filename in files:
+        entry = manifest.get(filename)
+        if entry is None or not os.path.isdir(saved_path(filename)):
+            changed.append(filename)
+            continue
+
+        # Parsing a single export would replace the history merged from all of them
+        if 'merged' in entry:
+            print('{} was merged from {}, run -merge again to update it'.format(filename, ', '.join(entry['merged'])))
+            continue
+
+        # Size and mtime are enough to skip a file; only hash when they differ
+        current = manifest_entry(filename, with_hash=False)
+        if current['size'] == entry['size'] and current['mtime'] == entry['mtime']:
+            continue
+
+        current['hash'] = hash_file('{}/{}'.format('./messages', filename))
+        if current['hash'] == entry['hash']:
+            manifest[filename] = current
+        else:
+            changed.append(filename)
+    return changed
+
+
 def load_all_saved_files():
     conversations = {}
     files = []
@@ -26,20 +583,21 @@ def load_all_saved_files():
         print('Loading Data...')
         for filename in files:
             if(filename.endswith('.pickle')):
-                with open ("./saved/{}".format(filename), 'rb') as fp:
-                    data = pickle.load(fp)
-                    conversations[filename[:-12]] = data
+                data = load_saved_file("./saved/{}".format(filename))
+                conversations[filename[:-12]] = data
+        for dirname in dirnames:
+            if(dirname.endswith('_data')):
+                data = load_saved_file("./saved/{}".format(dirname))
+                conversations[dirname[:-5]] = data
         break
     return conversations
 
 
-def analyze_all_files(conversations):
-    messages_by_conversation = {}
+def analyze_all_files(catalog):
     total_messages = 0
     total_conversations = 0
-    for filename in conversations:
-        num_messages = len(conversations[filename]['messages'])
-        messages_by_conversation[filename] = num_messages
+    for filename in catalog:
+        num_messages = catalog[filename]['messages']
         total_messages += num_messages
         if num_messages > 1:
             total_conversations += 1
@@ -47,9 +605,9 @@ def analyze_all_files(conversations):
     print('Total Messages: {:,}'.format(total_messages))
     print('Total Conversations: {:,}'.format(total_conversations))
 
-    for entry in sorted(messages_by_conversation.items(), key=lambda x:x[1]):
-        if entry[1] > 1:
-            print('{:>9} - {:<20} - {:,} Messages'.format((entry[0] + '.html'), conversations[entry[0]]['name'][:19], entry[1]))
+    for entry in sorted(catalog.items(), key=lambda x:x[1]['messages']):
+        if entry[1]['messages'] > 1:
+            print('{:>9} - {:<20} - {:,} Messages'.format(entry[0], entry[1]['name'][:19], entry[1]['messages']))
         
 
 def list_all_files():
@@ -57,23 +615,54 @@ def list_all_files():
     files = []
     for (dirpath, dirnames, filenames) in walk('{}'.format('./messages')):
         files.extend(filenames)
-        for filename in files:
-            with open('{}/{}'.format('./messages', filename), 'r', encoding="utf8") as f:
-                content = f.read()
-                walker = ParseHTMLForUsers()
-                try:
-                    walker.feed(content)
-                except StopIteration:
-                    name = walker.conversationName
-                    entry = {}
-                    entry['name'] = name
-                    entry['size'] = os.path.getsize('{}/{}'.format('./messages', filename))
-                    entry['filename'] = filename
-                    conversations.append(entry)
         break
+
+    # Titles are cached by filename and only re-read when size or mtime change
+    cache = load_json('./saved/titles.json')
+    titles = {}
+    for filename in files:
+        path = '{}/{}'.format('./messages', filename)
+        stat = os.stat(path)
+        entry = cache.get(filename)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime_ns:
+            name = read_conversation_name(path)
+            if name is None:
+                continue
+            entry = {
+                'name': name,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns,
+            }
+        titles[filename] = entry
+        conversations.append({
+            'name': entry['name'],
+            'size': entry['size'],
+            'filename': filename,
+        })
+
+    if titles != cache:
+        save_json('./saved/titles.json', titles)
     return conversations
 
 
+def read_conversation_name(path):
+    # The <title> is in the first few lines of an export, so only read that
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE).decode('utf8', errors='ignore')
+    match = re.search('<title>(.*?)</title>', header, re.DOTALL)
+    if match:
+        return html.unescape(match.group(1))[18:]
+
+    with open(path, 'r', encoding="utf8") as f:
+        walker = ParseHTMLForUsers()
+        try:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), ''):
+                walker.feed(chunk)
+        except StopIteration:
+            return walker.conversationName
+    return None
+
+
 def print_listed_files(conversations):
     sorted_conversations = sorted(conversations, key=lambda x:x['size'])
     for entry in sorted_conversations:
@@ -83,41 +672,1132 @@ def print_listed_files(conversations):
             entry['filename']))
 
 
-def find_file_by_conversation_name(conversation_name):
-    conversations = load_all_saved_files()
-    for filename in conversations:
-        if conversations[filename]['name'].startswith(conversation_name):
-            return conversations[filename]
+def find_file_by_conversation_name(conversation_name, start=None, end=None, user=None):
+    catalog = load_catalog()
+    for filename in catalog:
+        if catalog[filename]['name'].startswith(conversation_name):
+            return load_saved_file(saved_path(filename), start, end, user)
     
+    # Not parsed yet, look it up by title and parse it now
     conversations = list_all_files()
     for conversation in conversations:
         if conversation['name'].startswith(conversation_name):
-            return conversation
+            parse_changed_files([conversation['filename']])
+            return load_saved_file(saved_path(conversation['filename']), start, end, user)
     
     print("Could not find specified conversation.\n")
 
 
-def parse_file(filename):
-    with open("{}/{}".format('./messages', filename), 'r', encoding="utf8") as f:
+def parse_file(filename, verbose=True, force=False, fast=False, codec=KEEP_CODEC, depth=None, stats=None, digest=None):
+    # With a digest, the file's bytes are hashed into it as they are parsed
+    path = "{}/{}".format('./messages', filename)
+    if digest is None:
+        f = open(path, 'r', encoding="utf8")
+    else:
+        f = io.TextIOWrapper(io.BufferedReader(HashingReader(path, digest)), encoding="utf8")
+    with f:
         # If file already parsed skip this step
-        if not os.path.isfile("./saved/{}_data.pickle".format(filename[:-5])):
-            print('Parsing {}...'.format(filename), end="\r")
-            content = f.read()
-            parser = ParseHTMLForData()
-            parser.feed(content)
-            with open("./saved/{}_data.pickle".format(filename[:-5]), 'wb') as fp:
+        if force or not os.path.isdir(saved_path(filename)):
+            if verbose:
+                print('Parsing {}...'.format(filename), end="\r")
+            writer, parser = parse_stream(f, filename, fast, codec, depth, stats)
+            if verbose:
                 print('Saving {}...'.format(filename), end="\r")
-                data = { 
-                    'name': parser.conversationName,
-                    'messages': parser.msgs
-                }
-                pickle.dump(data, fp)
+            writer.close(parser.conversationName)
+    return filename
+
+
+def parse_stream(f, filename, fast=False, codec=KEEP_CODEC, depth=None, stats=None, path=None, zones=False):
+    # The fast scanner gives up on markup it does not know, in which case
+    # the file is parsed again from the start with HTMLParser. With depth,
+    # reading and writing run in threads of a Pipeline whose busy and
+    # waiting times are added to stats. Saved to path, by default the
+    # file's place in ./saved. With zones the parser's decoder keeps the
+    # UTC offset of every message.
+    for parser_class in ([ScanHTMLForData] if fast else []) + [ParseHTMLForData]:
+        f.seek(0)
+        writer = ConversationWriter(path or saved_path(filename), codec)
+        pipeline = Pipeline(f, writer, depth) if depth else None
+        parser = parser_class(on_batch=pipeline.write_batch if pipeline else writer.write_batch,
+            decoder=TimestampDecoder(zones=zones))
+        if profiler is not None:
+            finish = profiler.instrument(filename, f, parser, pipeline)
+        try:
+            if pipeline:
+                pipeline.start()
+                chunks = pipeline.chunks()
+            else:
+                chunks = iter(lambda: f.read(CHUNK_SIZE), '')
+            for chunk in chunks:
+                parser.feed(chunk)
+            parser.close()
+            if pipeline:
+                pipeline.close()
+        except UnexpectedMarkup as e:
+            if pipeline:
+                pipeline.abort()
+            writer.abort()
+            print('{}: {}, parsing with HTMLParser'.format(filename, e))
+            continue
+        except BaseException:
+            if pipeline:
+                pipeline.abort()
+            writer.abort()
+            raise
+        finally:
+            if profiler is not None:
+                finish(writer.count)
+        if pipeline and stats is not None:
+            stats.update(pipeline.stats)
+        return writer, parser
+
+
+class Pipeline():
+    # Overlaps reading, parsing and writing of a file. A reader thread keeps
+    # up to depth[0] chunks of PIPELINE_READ_SIZE read ahead and a writer thread takes up to
+    # depth[1] batches the parser is ahead by, while the calling thread
+    # parses. Seconds busy and waiting are counted per stage.
+    def __init__(self, f, writer, depth=(4, 4)):
+        self.f = f
+        self.writer = writer
+        self.chunkQueue = queue.Queue(depth[0])
+        self.batchQueue = queue.Queue(depth[1])
+        self.stopped = threading.Event()
+        self.error = None
+        self.stats = Counter(dict((key, 0.0) for key in (
+            'wall', 'read', 'parse', 'write', 'read_wait', 'parse_wait', 'write_wait')))
+        self.threads = [threading.Thread(target=self.read, daemon=True),
+            threading.Thread(target=self.write, daemon=True)]
+
+    def start(self):
+        self.started = time.perf_counter()
+        for thread in self.threads:
+            thread.start()
+
+    def read(self):
+        try:
+            while not self.stopped.is_set():
+                start = time.perf_counter()
+                chunk = self.f.read(PIPELINE_READ_SIZE)
+                self.stats['read'] += time.perf_counter() - start
+                start = time.perf_counter()
+                self.chunkQueue.put(chunk)
+                self.stats['read_wait'] += time.perf_counter() - start
+                if not chunk:
+                    return
+        except BaseException as e:
+            self.error = e
+            self.chunkQueue.put('')
+
+    def chunks(self):
+        while True:
+            start = time.perf_counter()
+            chunk = self.chunkQueue.get()
+            self.stats['parse_wait'] += time.perf_counter() - start
+            if not chunk:
+                return
+            start = time.perf_counter()
+            waited = self.stats['parse_wait']
+            yield chunk
+            # Waiting for the writer in write_batch is not parsing
+            self.stats['parse'] += time.perf_counter() - start - (self.stats['parse_wait'] - waited)
+
+    def write_batch(self, messages):
+        # on_batch of the parser, blocking while the writer is too far behind
+        start = time.perf_counter()
+        self.batchQueue.put(messages)
+        self.stats['parse_wait'] += time.perf_counter() - start
+
+    def write(self):
+        # After an error batches are only taken off the queue, so the parser never blocks
+        while True:
+            start = time.perf_counter()
+            messages = self.batchQueue.get()
+            self.stats['write_wait'] += time.perf_counter() - start
+            if messages is None:
+                return
+            if self.error is None:
+                start = time.perf_counter()
+                try:
+                    self.writer.write_batch(messages)
+                except BaseException as e:
+                    self.error = e
+                self.stats['write'] += time.perf_counter() - start
+
+    def close(self):
+        # Waits for the last batches to be written, raising any error of the threads
+        self.batchQueue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.stats['wall'] = time.perf_counter() - self.started
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        self.stopped.set()
+        while self.threads[0].is_alive():
+            try:
+                self.chunkQueue.get(timeout=0.01)
+            except queue.Empty:
+                pass
+        self.batchQueue.put(None)
+        self.threads[1].join()
+
+
+def print_pipeline_stats(stats, files):
+    wall = stats['wall']
+    if not wall:
+        return
+    print('Pipeline over {} files, {:.2f}s: read {:.0%} busy, parse {:.0%} busy, write {:.0%} busy'.format(
+        files, wall, stats['read'] / wall, stats['parse'] / wall, stats['write'] / wall))
+    print('Parser waited {:.2f}s for chunks or the writer, reader {:.2f}s on a full queue, writer {:.2f}s for batches'.format(
+        stats['parse_wait'], stats['read_wait'], stats['write_wait']))
+
+
+def load_saved_file(path, start=None, end=None, user=None):
+    # Messages sent from start until before end by users whose name starts
+    # with user, all of them by default. Filtered loads read only partitions
+    # holding such messages, or everything from data saved without them.
+    filtered = start is not None or end is not None or user is not None
+    if not os.path.isdir(path):
+        data = load_pickled_file(path)
+        if filtered:
+            data['messages'] = MessageColumns.from_messages(data['messages']).where(start, end, user)
+        return data
+
+    meta = load_json(os.path.join(path, 'meta.json'))
+    if meta['byteorder'] != sys.byteorder:
+        raise ValueError('{} was saved on a {} endian machine, parse it again'.format(path, meta['byteorder']))
+    if filtered and 'partitions' in meta:
+        user_ids = None if user is None else set(i for i, name in enumerate(meta['users']) if name.startswith(user))
+        messages = load_partitions(path, meta, select_partitions(meta, start, end, user_ids))
+        return {
+            'name': meta['name'],
+            'messages': messages.where(start, end, user)
+        }
 
+    messages = MessageColumns(
+        meta['users'],
+        read_column(path, 'dates', 'q', meta),
+        read_column(path, 'users', 'H', meta),
+        read_column(path, 'offsets', 'q', meta),
+        read_column(path, 'text', None, meta))
+
+    # Rollups are missing in data saved before they were added
+    for kind in ROLLUPS:
+        if os.path.isfile(os.path.join(path, 'rollup_{}.bin'.format(kind))):
+            messages.rollups[kind] = map_column(os.path.join(path, 'rollup_{}.bin'.format(kind)), 'q')
+
+    # So are text features, without which algorithms read the text instead
+    if os.path.isfile(os.path.join(path, 'vocab.json')):
+        messages.features = {'vocab': load_json(os.path.join(path, 'vocab.json'))}
+        for column, typecode in COLUMNS[4:]:
+            messages.features[column] = read_column(path, column, typecode, meta)
+    if filtered:
+        messages = messages.where(start, end, user)
+    return {
+        'name': meta['name'],
+        'messages': messages
+    }
+
+
+def select_partitions(meta, start=None, end=None, user_ids=None):
+    # Partitions with messages in the date range by one of user_ids
+    selected = []
+    for i, partition in enumerate(meta['partitions']):
+        if start is not None and partition['last'] < start:
+            continue
+        if end is not None and partition['first'] >= end:
+            continue
+        if user_ids is not None and user_ids.isdisjoint(partition['users']):
+            continue
+        selected.append(i)
+    return selected
+
+
+def load_partitions(path, meta, selected):
+    # In-memory columns of the selected partitions, their end offsets made
+    # relative to the text and tokens read with them
+    def column(name, typecode):
+        values = array(typecode)
+        values.frombytes(b''.join(read_partitions(path, name, meta, selected)))
+        return values
+
+    def offsets(name, data):
+        starts = partition_starts(data, meta)
+        itemsize = 1 if data == 'text' else array(dict(COLUMNS)[data]).itemsize
+        joined = [np.zeros(1, dtype=np.int64)]
+        size = 0
+        for i, ends in zip(selected, read_partitions(path, name, meta, selected)):
+            # The leading zero is stored with the first partition
+            ends = np.frombuffer(ends, dtype=np.int64)[1 if i == 0 else 0:] - starts[i] // itemsize
+            joined.append(ends + size)
+            size += int(ends[-1])
+        values = array('q')
+        values.frombytes(np.concatenate(joined).tobytes())
+        return values
+
+    messages = MessageColumns(meta['users'], column('dates', 'q'), column('users', 'H'),
+        offsets('offsets', 'text'), b''.join(read_partitions(path, 'text', meta, selected)))
+    if os.path.isfile(os.path.join(path, 'vocab.json')):
+        messages.features = {
+            'vocab': load_json(os.path.join(path, 'vocab.json')),
+            'words': column('words', 'I'),
+            'letters': column('letters', 'I'),
+            'tokens': column('tokens', 'I'),
+            'token_offsets': offsets('token_offsets', 'tokens'),
+        }
+    return messages
+
+
+def load_pickled_file(path):
+    data = {'messages': []}
+    with open(path, 'rb') as fp:
+        while True:
+            try:
+                entry = pickle.load(fp)
+            except EOFError:
+                break
+            if isinstance(entry, list):
+                data['messages'].extend(entry)
+            elif 'messages' in entry:
+                # Saved as a single dict before streaming ingest
+                return entry
+            else:
+                data.update(entry)
+    return data
 
-class ParseHTMLForData(HTMLParser):
-    def __init__(self):
-        super(ParseHTMLForData, self).__init__()
+
+def read_column(path, column, typecode=None, meta=None):
+    # Uncompressed columns are memory-mapped, compressed ones read whole
+    codec = (meta or {}).get('codec')
+    if codec is None:
+        return map_column(os.path.join(path, column + '.bin'), typecode)
+
+    # Columns compressed before partitions are a single frame
+    with open(os.path.join(path, column + '.bin' + CODECS[codec][0]), 'rb') as f:
+        if 'frames' not in meta:
+            data = decode_frame(f.read(), column, meta)
+        else:
+            data = b''.join([decode_frame(f.read(size), column, meta) for size in meta['frames'][column]])
+    if typecode is None:
+        return data
+    return memoryview(data).cast(typecode)
+
+
+def read_partitions(path, column, meta, selected):
+    # Bytes of the selected partitions of a column, reading nothing else
+    if meta.get('codec') is None:
+        data = map_column(os.path.join(path, column + '.bin'))
+        starts = partition_starts(column, meta) + [len(data)]
+        return [data[starts[i]:starts[i + 1]] for i in selected]
+
+    frames = meta['frames'][column]
+    positions = [0] + list(accumulate(frames))
+    partitions = []
+    with open(os.path.join(path, column + '.bin' + CODECS[meta['codec']][0]), 'rb') as f:
+        for i in selected:
+            f.seek(positions[i])
+            partitions.append(decode_frame(f.read(frames[i]), column, meta))
+    return partitions
+
+
+def partition_starts(column, meta):
+    # Byte offset of every partition in a column. The leading zero of the
+    # end offsets belongs to the first partition.
+    partitions = meta['partitions']
+    if column == 'text':
+        ends = [partition['text'] for partition in partitions]
+    elif column == 'tokens':
+        ends = [partition['tokens'] * 4 for partition in partitions]
+    elif column in ('offsets', 'token_offsets'):
+        ends = [(partition['rows'] + 1) * 8 for partition in partitions]
+    else:
+        ends = [partition['rows'] * array(dict(COLUMNS)[column]).itemsize for partition in partitions]
+    return [0] + ends[:-1]
+
+
+def decode_frame(data, column, meta):
+    data = CODECS[meta['codec']][2](data)
+    if column in meta.get('delta', ()):
+        data = np.cumsum(np.frombuffer(data, dtype=np.int64)).tobytes()
+    return data
+
+
+def compress_column(path, codec, delta=False, frames=()):
+    # Replaces a column file with its compressed version, a block at a time,
+    # starting a new frame at every offset of frames. Returns frame sizes.
+    suffix, compressor, decompress = CODECS[codec]
+    sizes = []
+    position = 0
+    with open(path, 'rb') as src, open(path + suffix, 'wb') as dst:
+        for end in list(frames) + [os.fstat(src.fileno()).st_size]:
+            frame = compressor()
+            previous = 0
+            start = dst.tell()
+            while position < end:
+                block = src.read(min(COMPRESS_BLOCK, end - position))
+                position += len(block)
+                if delta:
+                    values = np.frombuffer(block, dtype=np.int64)
+                    block = np.diff(values, prepend=previous).tobytes()
+                    previous = values[-1]
+                dst.write(frame.compress(block))
+            dst.write(frame.flush())
+            sizes.append(dst.tell() - start)
+    os.remove(path)
+    return sizes
+
+
+def compress_saved_files(codec):
+    # Rewrites saved conversations not stored with codec (None to store
+    # them uncompressed and memory-mapped again), then reports the ratio
+    files = []
+    for (dirpath, dirnames, filenames) in walk('{}'.format('./saved')):
+        files.extend(dirname for dirname in dirnames if dirname.endswith('_data'))
+        break
+
+    changed = []
+    raw = stored = 0
+    start = time.perf_counter()
+    for dirname in sorted(files):
+        path = './saved/{}'.format(dirname)
+        meta = load_json(os.path.join(path, 'meta.json'))
+        if meta.get('codec') != codec or 'partitions' not in meta:
+            print('Compressing {}...'.format(dirname), end="\r")
+            data = load_saved_file(path)
+            writer = ConversationWriter(path, codec)
+            writer.write_columns(data['messages'])
+            writer.close(data['name'])
+            changed.append(dirname[:-5] + '.html')
+            meta = load_json(os.path.join(path, 'meta.json'))
+        raw += meta.get('raw_bytes', 0)
+        stored += sum(os.path.getsize(os.path.join(path, column + '.bin' + (CODECS[codec][0] if codec else '')))
+            for column, typecode in COLUMNS)
+    update_catalog(changed)
+
+    print('Stored {} conversations as {} in {:.1f}s, {} rewritten'.format(
+        len(files), codec or 'uncompressed', time.perf_counter() - start, len(changed)))
+    print('Columns: {:,.1f} MB in {:,.1f} MB ({:.2f}x)'.format(
+        raw / 1024 / 1024, stored / 1024 / 1024, raw / max(stored, 1)))
+
+
+def map_column(path, typecode=None):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            column = b''
+        else:
+            column = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if typecode is None:
+        return column
+    return memoryview(column).cast(typecode)
+
+
+def migrate_saved_files(codec=KEEP_CODEC):
+    files = []
+    for (dirpath, dirnames, filenames) in walk('{}'.format('./saved')):
+        files.extend(filenames)
+        break
+
+    migrated = []
+    for filename in files:
+        if filename.endswith('_data.pickle'):
+            print('Migrating {}...'.format(filename))
+            data = load_pickled_file('./saved/{}'.format(filename))
+            writer = ConversationWriter('./saved/{}'.format(filename[:-7]), codec)
+            for i in range(0, len(data['messages']), BATCH_SIZE):
+                writer.write_batch(data['messages'][i:i + BATCH_SIZE])
+            writer.close(data['name'])
+            migrated.append(filename[:-12] + '.html')
+    update_catalog(migrated)
+    update_search_index(migrated)
+    print("Done.")
+
+
+@lru_cache(maxsize=None)
+def load_stopwords():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'most-common-polish.json')
+    with open(path, 'r', encoding="utf8") as fp:
+        return frozenset(word.translate(WORD_TABLE) for word in json.load(fp)['words'])
+
+
+def day_to_date(day):
+    return EPOCH.date() + datetime.timedelta(days=day)
+
+
+def count_letters(text):
+    # Counting the characters to skip is much faster than deleting them
+    return len(text) - sum(map(text.count, NOT_LETTERS))
+
+
+def to_timestamp(date):
+    return (date - EPOCH) // datetime.timedelta(seconds=1)
+
+
+def from_timestamp(timestamp):
+    return EPOCH + datetime.timedelta(seconds=timestamp)
+
+
+class Profiler():
+    # Wall time, CPU time, bytes, messages and, with memory, peak traced
+    # allocation of each stage of each file, kept as events for the summary
+    # table and the trace. Tracing allocations slows down every stage many
+    # times over, so it is only done when asked for. Workers of a pool
+    # collect their events and hand them to the main process.
+    def __init__(self, origin=None, worker=False, memory=False):
+        self.origin = time.perf_counter() if origin is None else origin
+        self.worker = worker
+        self.memory = memory
+        self.events = []
+        self.peaks = []
+        if memory:
+            tracemalloc.start()
+
+    def add(self, stage, file, start, wall, cpu, bytes=0, messages=0, peak=None, calls=1):
+        self.events.append({
+            'stage': stage,
+            'file': file,
+            'pid': os.getpid(),
+            'start': start - self.origin,
+            'wall': wall,
+            'cpu': cpu,
+            'bytes': bytes,
+            'messages': messages,
+            'peak': peak,
+            'calls': calls,
+        })
+
+    @contextmanager
+    def stage(self, stage, file=None):
+        # Peaks are reset per stage, so an enclosing stage keeps the
+        # highest peak of the stages inside it
+        record = {'file': file, 'bytes': 0, 'messages': 0}
+        if not self.memory:
+            start, cpu = time.perf_counter(), time.process_time()
+            try:
+                yield record
+            finally:
+                self.add(stage, record['file'], start, time.perf_counter() - start, time.process_time() - cpu,
+                    record['bytes'], record['messages'])
+            return
+
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], tracemalloc.get_traced_memory()[1])
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        self.peaks.append(0)
+        start, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            wall, cpu = time.perf_counter() - start, time.process_time() - cpu
+            peak = max(self.peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if self.peaks:
+                self.peaks[-1] = max(self.peaks[-1], peak)
+            tracemalloc.reset_peak()
+            self.add(stage, record['file'], start, wall, cpu, record['bytes'], record['messages'], peak - base)
+
+    def instrument(self, filename, f, parser, pipeline=None):
+        # Times reading, tokenising, date decoding and writing of one parse.
+        # Batches are handed on and dates decoded from inside feed and close,
+        # so those are taken out of the tokenising time. With a pipeline the
+        # parser only enqueues batches, which is timed as its own stage, and
+        # write is timed in the writer thread.
+        stages = ('read', 'tokenise', 'decode', 'write') + (('enqueue',) if pipeline else ())
+        timers = dict((stage, StageTimer(stage)) for stage in stages)
+        f.read = timers['read'].wrap(f.read)
+        parser.feed = timers['tokenise'].wrap(parser.feed)
+        parser.close = timers['tokenise'].wrap(parser.close)
+        parser.decoder.decode = timers['decode'].wrap(parser.decoder.decode)
+        if pipeline:
+            parser.onBatch = timers['enqueue'].wrap(parser.onBatch)
+            pipeline.writer.write_batch = timers['write'].wrap(pipeline.writer.write_batch)
+        else:
+            parser.onBatch = timers['write'].wrap(parser.onBatch)
+        handoff = timers['enqueue' if pipeline else 'write']
+
+        def finish(messages):
+            del f.read
+            timers['tokenise'].wall -= timers['decode'].wall + handoff.wall
+            timers['tokenise'].cpu -= timers['decode'].cpu + handoff.cpu
+            timers['read'].bytes = f.tell()
+            for stage, timer in timers.items():
+                self.add(stage, filename, timer.start, timer.wall, timer.cpu, timer.bytes,
+                    0 if stage == 'read' else messages, calls=timer.calls)
+        return finish
+
+    def collect(self):
+        if not self.worker:
+            return []
+        events, self.events = self.events, []
+        return events
+
+    def summary(self):
+        stages = {}
+        for event in self.events:
+            stage = stages.setdefault(event['stage'], {
+                'calls': 0, 'files': set(), 'wall': 0.0, 'cpu': 0.0, 'bytes': 0, 'messages': 0, 'peak': None})
+            stage['calls'] += event['calls']
+            stage['files'].add(event['file'])
+            stage['wall'] += event['wall']
+            stage['cpu'] += event['cpu']
+            stage['bytes'] += event['bytes']
+            stage['messages'] += event['messages']
+            if event['peak'] is not None:
+                stage['peak'] = max(stage['peak'] or 0, event['peak'])
+        for stage in stages.values():
+            stage['files'] = len(stage['files'] - {None})
+            stage['messages_per_second'] = stage['messages'] / stage['wall'] if stage['wall'] > 0 else None
+        return stages
+
+    def print_summary(self):
+        print('\n{:<30} {:>7} {:>6} {:>9} {:>9} {:>9} {:>11} {:>12} {:>9}'.format(
+            'Stage', 'Calls', 'Files', 'Wall s', 'CPU s', 'MB', 'Messages', 'Messages/s', 'Peak MB'))
+        for name, stage in self.summary().items():
+            print('{:<30} {:>7,} {:>6,} {:>9.3f} {:>9.3f} {:>9.1f} {:>11,} {:>12} {:>9}'.format(
+                name[:30], stage['calls'], stage['files'], stage['wall'], stage['cpu'],
+                stage['bytes'] / 1024 / 1024, stage['messages'],
+                '{:,.0f}'.format(stage['messages_per_second']) if stage['messages'] else '',
+                '{:.1f}'.format(stage['peak'] / 1024 / 1024) if stage['peak'] is not None else ''))
+
+    def save(self, path):
+        # Chrome trace format, loadable in chrome://tracing or Perfetto. Stages
+        # summed over many calls get a row of their own per process.
+        lanes = {}
+        events = []
+        for event in self.events:
+            if event['calls'] > 1 or event['stage'] in ('read', 'tokenise', 'decode', 'write', 'enqueue'):
+                tid = lanes.setdefault(event['stage'], len(lanes) + 1)
+            else:
+                tid = 0
+            events.append({
+                'name': event['stage'],
+                'cat': event['file'] or '',
+                'ph': 'X',
+                'ts': event['start'] * 1e6,
+                'dur': event['wall'] * 1e6,
+                'pid': event['pid'],
+                'tid': tid,
+                'args': dict((key, event[key]) for key in ('file', 'cpu', 'bytes', 'messages', 'peak', 'calls')),
+            })
+        save_json(path, {
+            'traceEvents': events,
+            'displayTimeUnit': 'ms',
+            'stages': self.summary(),
+            'events': self.events,
+        })
+
+
+class StageTimer():
+    # Sums the time of many short calls, like reading chunks or decoding
+    # dates, into one profile event. CPU time is that of the calling thread,
+    # as -pipeline runs stages in threads of their own.
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = time.perf_counter()
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.calls = 0
+        self.bytes = 0
+
+    def wrap(self, func):
+        @wraps(func)
+        def timed(*args):
+            start, cpu = time.perf_counter(), time.thread_time()
+            try:
+                return func(*args)
+            finally:
+                self.wall += time.perf_counter() - start
+                self.cpu += time.thread_time() - cpu
+                self.calls += 1
+        return timed
+
+
+def profiled(func, stage, describe):
+    # describe(args, result) gives the file, bytes and messages of a call
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if profiler is None:
+            return func(*args, **kwargs)
+        with profiler.stage(stage) as record:
+            result = func(*args, **kwargs)
+            record.update(describe(args, result))
+        return result
+    wrapper.profiled = True
+    return wrapper
+
+
+def describe_analytics(args, result):
+    return {'file': args[0].name, 'messages': getattr(args[0], 'totalMessages', 0)}
+
+
+def describe_writer(args, result):
+    return {'file': os.path.basename(args[0].path), 'messages': args[0].count}
+
+
+# Functions and ComputeCoolStuff methods timed as stages by -profile
+PROFILED_FUNCTIONS = {
+    'parse_file': lambda args, result: {
+        'file': args[0],
+        'bytes': os.path.getsize('{}/{}'.format('./messages', args[0])),
+        'messages': load_json(os.path.join(saved_path(args[0]), 'meta.json')).get('messages', 0),
+    },
+    'load_saved_file': lambda args, result: {
+        'file': os.path.basename(args[0]),
+        'messages': len(result['messages']),
+    },
+    'update_catalog': lambda args, result: {},
+    'message_terms': lambda args, result: {'file': args[0], 'terms': len(result)},
+    'update_search_index': lambda args, result: {},
+}
+PROFILED_METHODS = ('compute_breaks', 'compute_total_words_by_user', 'getAllWords', 'printUserStats',
+    'plot_daily_activity', 'plot_messages_by_user_by_week', 'plot_messages_by_week')
+
+
+def start_profiler(origin=None, worker=False, memory=False):
+    global profiler
+    profiler = Profiler(origin, worker, memory)
+    # Forked workers inherit the wrappers, which look up the profiler on every call
+    module = globals()
+    for name, describe in PROFILED_FUNCTIONS.items():
+        if not getattr(module[name], 'profiled', False):
+            module[name] = profiled(module[name], name, describe)
+    methods = [(ConversationWriter, 'close', 'save', describe_writer),
+        (GlobalStats, 'print_stats', 'print_stats', describe_analytics),
+        (GlobalStats, 'plot_daily_activity', 'plot_daily_activity', describe_analytics)]
+    methods.extend((ComputeCoolStuff, name, name, describe_analytics) for name in PROFILED_METHODS)
+    for cls, name, stage, describe in methods:
+        method = getattr(cls, name)
+        if not getattr(method, 'profiled', False):
+            setattr(cls, name, profiled(method, stage, describe))
+    return profiler
+
+
+def worker_profiler_args():
+    # Pool arguments starting a profiler in every worker when profiling
+    if profiler is None:
+        return ()
+    return (start_profiler, (profiler.origin, True, profiler.memory))
+
+
+class ConversationWriter():
+    # A saved conversation is a directory of columns: epoch seconds (int64),
+    # user ids (uint16) indexing meta.json's user list, and message text as
+    # one utf8 blob with int64 end offsets. Message counts by user per day,
+    # week and minute of the day are rolled up as batches are written. It is
+    # written next to the old data and moved into place only once complete.
+    # Text features are saved with every message too: its word and letter
+    # counts (uint32) for -wordstats, and ids of its -topwords words (uint32)
+    # in the conversation's vocab.json, with int64 end offsets. Columns are
+    # compressed with one of CODECS once complete if a codec is given, a
+    # frame per partition of PARTITION_SIZE messages. KEEP_CODEC takes the
+    # codec of the conversation already saved at path.
+    def __init__(self, path, codec=None):
+        self.path = path
+        if codec == KEEP_CODEC:
+            codec = load_json(os.path.join(path, 'meta.json')).get('codec')
+        self.codec = codec
+        self.tmp = path + '.tmp'
+        if os.path.isdir(self.tmp):
+            shutil.rmtree(self.tmp)
+        os.makedirs(self.tmp)
+
+        self.users = {}
+        self.count = 0
+        self.textSize = 0
+        self.vocab = {}
+        self.tokenCount = 0
+        self.first = None
+        self.last = None
+        self.rollups = {'day': Counter(), 'minute': Counter()}
+        self.columns = dict((column, open(os.path.join(self.tmp, column + '.bin'), 'wb'))
+            for column, typecode in COLUMNS)
+        self.columns['offsets'].write(array('q', [0]).tobytes())
+        self.columns['token_offsets'].write(array('q', [0]).tobytes())
+
+    def write_batch(self, messages):
+        dates = array('q')
+        users = array('H')
+        offsets = array('q')
+        texts = []
+        for message in messages:
+            dates.append(to_timestamp(message['date']))
+            users.append(self.users.setdefault(message['user'], len(self.users)))
+            text = message['message'].encode('utf8')
+            self.textSize += len(text)
+            offsets.append(self.textSize)
+            texts.append(text)
+
+        # Words of the whole batch are folded in one translate call
+        split = [message['message'].split() for message in messages]
+        words = array('I', map(len, split))
+        letters = array('I', [count_letters(message['message']) for message in messages])
+        long_words = [[word for word in message if len(word) > MIN_WORD_LENGTH] for message in split]
+        tokens = array('I')
+        if any(long_words):
+            folded = '\n'.join(['\n'.join(message) for message in long_words if message]).lower().translate(WORD_TABLE)
+            tokens.extend([self.vocab.setdefault(word, len(self.vocab)) for word in folded.split('\n')])
+        token_offsets = array('q', accumulate(map(len, long_words), initial=self.tokenCount))[1:]
+
+        self.columns['dates'].write(dates.tobytes())
+        self.columns['users'].write(users.tobytes())
+        self.columns['offsets'].write(offsets.tobytes())
+        self.columns['text'].write(b''.join(texts))
+        self.columns['words'].write(words.tobytes())
+        self.columns['letters'].write(letters.tobytes())
+        self.columns['tokens'].write(tokens.tobytes())
+        self.columns['token_offsets'].write(token_offsets.tobytes())
+        self.tokenCount += len(tokens)
+        self.count += len(messages)
+        self.rollups['day'].update(zip([date // 86400 for date in dates], users))
+        self.rollups['minute'].update(zip([date % 86400 // 60 for date in dates], users))
+        if dates:
+            self.first = min(dates) if self.first is None else min(self.first, min(dates))
+            self.last = max(dates) if self.last is None else max(self.last, max(dates))
+
+    def write_columns(self, messages):
+        # Copies the columns of a saved conversation, to store it with another
+        # codec. Data saved before text features is written message by message.
+        if not messages.features:
+            for i in range(0, len(messages), BATCH_SIZE):
+                self.write_batch(messages[i:i + BATCH_SIZE])
+            return
+
+        dates = np.frombuffer(messages.dates, dtype=np.int64)
+        self.users = dict((user, i) for i, user in enumerate(messages.users))
+        self.vocab = dict((word, i) for i, word in enumerate(messages.features['vocab']))
+        self.count = len(messages)
+        self.textSize = len(messages.text)
+        self.tokenCount = len(messages.features['tokens'])
+        if len(dates):
+            self.first = int(dates.min())
+            self.last = int(dates.max())
+        columns = (messages.dates, messages.user_ids, messages.offsets[1:], messages.text,
+            messages.features['words'], messages.features['letters'], messages.features['tokens'],
+            messages.features['token_offsets'][1:])
+        for (column, typecode), data in zip(COLUMNS, columns):
+            self.columns[column].write(data)
+
+        # The rollups are recounted, only day and minute are kept while writing
+        for kind in ('day', 'minute'):
+            if kind in messages.rollups:
+                rows = np.frombuffer(messages.rollups[kind], dtype=np.int64).reshape(-1, 3)
+                self.rollups[kind] = Counter(dict((((key, user), count) for key, user, count in rows.tolist())))
+            else:
+                keys = dates // 86400 if kind == 'day' else dates % 86400 // 60
+                self.rollups[kind] = Counter(zip(keys.tolist(), messages.user_ids.tolist()))
+
+    def close(self, name):
+        for column in self.columns.values():
+            column.close()
+
+        raw_bytes = sum(os.path.getsize(os.path.join(self.tmp, column + '.bin')) for column, typecode in COLUMNS)
+        partitions = self.partitions()
+        frames = {}
+        if self.codec is not None:
+            for column, typecode in COLUMNS:
+                frames[column] = compress_column(os.path.join(self.tmp, column + '.bin'), self.codec,
+                    column in DELTA_COLUMNS, partition_starts(column, {'partitions': partitions})[1:])
+
+        self.rollups['week'] = Counter()
+        for (day, user), count in self.rollups['day'].items():
+            self.rollups['week'][(day - (day + 4) % 7, user)] += count
+        for kind in ROLLUPS:
+            # Rows of (day, week or minute; user id; count) sorted by key
+            table = array('q')
+            for (key, user), count in sorted(self.rollups[kind].items()):
+                table.extend((key, user, count))
+            with open(os.path.join(self.tmp, 'rollup_{}.bin'.format(kind)), 'wb') as fp:
+                fp.write(table.tobytes())
+
+        save_json(os.path.join(self.tmp, 'vocab.json'), list(self.vocab))
+        save_json(os.path.join(self.tmp, 'meta.json'), {
+            'name': name,
+            'users': list(self.users),
+            'messages': self.count,
+            'first': self.first,
+            'last': self.last,
+            'byteorder': sys.byteorder,
+            'codec': self.codec,
+            'delta': list(DELTA_COLUMNS) if self.codec else [],
+            'raw_bytes': raw_bytes,
+            'partitions': partitions,
+            'frames': frames,
+        })
+
+        if os.path.isdir(self.path):
+            os.replace(self.path, self.path + '.old')
+            os.replace(self.tmp, self.path)
+            shutil.rmtree(self.path + '.old')
+        else:
+            os.replace(self.tmp, self.path)
+        if os.path.isfile(self.path + '.pickle'):
+            os.remove(self.path + '.pickle')
+
+    def partitions(self):
+        # Rows, date range, user ids and text and token end offsets of
+        # every PARTITION_SIZE messages, read back from the written columns
+        partitions = []
+        files = dict((column, open(os.path.join(self.tmp, column + '.bin'), 'rb'))
+            for column in ('dates', 'users', 'offsets', 'token_offsets'))
+        try:
+            files['offsets'].seek(8)
+            files['token_offsets'].seek(8)
+            for rows in range(0, self.count, PARTITION_SIZE):
+                size = min(PARTITION_SIZE, self.count - rows)
+                dates = np.frombuffer(files['dates'].read(size * 8), dtype=np.int64)
+                users = np.frombuffer(files['users'].read(size * 2), dtype=np.uint16)
+                partitions.append({
+                    'rows': rows + size,
+                    'first': int(dates.min()),
+                    'last': int(dates.max()),
+                    'users': np.unique(users).tolist(),
+                    'text': int(np.frombuffer(files['offsets'].read(size * 8), dtype=np.int64)[-1]),
+                    'tokens': int(np.frombuffer(files['token_offsets'].read(size * 8), dtype=np.int64)[-1]),
+                })
+        finally:
+            for f in files.values():
+                f.close()
+        return partitions
+
+    def abort(self):
+        for column in self.columns.values():
+            column.close()
+        shutil.rmtree(self.tmp)
+
+
+class Message():
+    # A parsed message, read like the {'user','message','date'} dicts messages
+    # used to be. Slots take a fraction of a dict's memory, and parsers intern
+    # user names so every message of a user shares one string.
+    __slots__ = ('user', 'message', 'date')
+
+    def __init__(self, user, message, date):
+        self.user = user
+        self.message = message
+        self.date = date
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def keys(self):
+        return self.__slots__
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            other = dict(other)
+        return dict(self) == other
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class MessageColumns():
+    # Sequence of Message records backed by the saved columns,
+    # which algorithms can also read directly
+    def __init__(self, users, dates, user_ids, offsets, text):
+        self.users = users
+        self.dates = dates
+        self.user_ids = user_ids
+        self.offsets = offsets
+        self.text = text
+        self.rollups = {}
+        self.features = {}
+
+    @classmethod
+    def from_messages(cls, messages):
+        users = {}
+        dates = array('q')
+        user_ids = array('H')
+        offsets = array('q', [0])
+        texts = []
+        size = 0
+        for message in messages:
+            dates.append(to_timestamp(message['date']))
+            user_ids.append(users.setdefault(message['user'], len(users)))
+            text = message['message'].encode('utf8')
+            size += len(text)
+            offsets.append(size)
+            texts.append(text)
+        return cls(list(users), dates, user_ids, offsets, b''.join(texts))
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        return Message(self.users[self.user_ids[i]], self.get_text(i), from_timestamp(self.dates[i]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def get_text(self, i):
+        return self.text[self.offsets[i]:self.offsets[i + 1]].decode('utf8')
+
+    def where(self, start=None, end=None, user=None):
+        # Messages sent from start until before end by users whose name
+        # starts with user, itself when that is all of them
+        keep = np.ones(len(self), dtype=bool)
+        dates = np.frombuffer(self.dates, dtype=np.int64)
+        if start is not None:
+            keep &= dates >= start
+        if end is not None:
+            keep &= dates < end
+        if user is not None:
+            user_ids = [i for i, name in enumerate(self.users) if name.startswith(user)]
+            keep &= np.isin(np.frombuffer(self.user_ids, dtype=np.uint16), user_ids)
+        if keep.all():
+            return self
+        rows = np.flatnonzero(keep)
+        if len(rows) and rows[-1] - rows[0] == len(rows) - 1:
+            # A date range of messages saved in order
+            return self.view(int(rows[0]), int(rows[-1]) + 1)
+        return self.take(rows.tolist())
+
+    def view(self, start, stop):
+        # Columns of messages start to stop, with end offsets made relative
+        # to the copied text and tokens
+        def rebased(offsets):
+            offsets = np.frombuffer(offsets, dtype=np.int64)[start:stop + 1]
+            values = array('q')
+            values.frombytes((offsets - offsets[0]).tobytes())
+            return values, int(offsets[0]), int(offsets[-1])
+
+        offsets, first, last = rebased(self.offsets)
+        columns = MessageColumns(self.users, array('q', self.dates[start:stop]),
+            array('H', self.user_ids[start:stop]), offsets, self.text[first:last])
+        if self.features:
+            token_offsets, first, last = rebased(self.features['token_offsets'])
+            columns.features = {
+                'vocab': self.features['vocab'],
+                'words': array('I', self.features['words'][start:stop]),
+                'letters': array('I', self.features['letters'][start:stop]),
+                'tokens': array('I', self.features['tokens'][first:last]),
+                'token_offsets': token_offsets,
+            }
+        return columns
+
+    def take(self, rows):
+        # In-memory columns of just the given message offsets
+        offsets = array('q', [0])
+        texts = []
+        size = 0
+        for i in rows:
+            text = self.text[self.offsets[i]:self.offsets[i + 1]]
+            size += len(text)
+            offsets.append(size)
+            texts.append(text)
+        columns = MessageColumns(self.users,
+            array('q', (self.dates[i] for i in rows)),
+            array('H', (self.user_ids[i] for i in rows)),
+            offsets, b''.join(texts))
+
+        if self.features:
+            tokens = array('I')
+            token_offsets = array('q', [0])
+            for i in rows:
+                tokens.extend(self.features['tokens'][self.features['token_offsets'][i]:self.features['token_offsets'][i + 1]])
+                token_offsets.append(len(tokens))
+            columns.features = {
+                'vocab': self.features['vocab'],
+                'words': array('I', (self.features['words'][i] for i in rows)),
+                'letters': array('I', (self.features['letters'][i] for i in rows)),
+                'tokens': tokens,
+                'token_offsets': token_offsets,
+            }
+        return columns
+
+
+class TimestampDecoder():
+    # Dates look like 'Friday, 24 November 2017 at 14:09 UTC+01'. The format
+    # of the date part is detected on the first message and every day is only
+    # parsed once; the clock is read by slicing. Dates stay in the local time
+    # they were exported in. With zones, the UTC offset of every decoded date
+    # is appended to zones in minutes, for -merge to match messages of exports
+    # made in different time zones.
+    DATE_FORMATS = ('%A, %d %B %Y', '%A, %B %d, %Y', '%d %B %Y', '%B %d, %Y', '%Y-%m-%d')
+    MINUTES = [datetime.timedelta(minutes=minute) for minute in range(24 * 60)]
+    ZONE = re.compile(r'(?:UTC|GMT)([+-])(\d{1,2})(?::?(\d{2}))?$')
+
+    def __init__(self, cache_size=4096, zones=False):
+        self.dateFormat = None
+        self.parse_day = lru_cache(maxsize=cache_size)(self.parse_day)
+        self.parse_zone = lru_cache(maxsize=None)(self.parse_zone)
+        self.zones = array('h') if zones else None
+
+    def detect_format(self, day):
+        for date_format in self.DATE_FORMATS:
+            try:
+                datetime.datetime.strptime(day, date_format)
+            except ValueError:
+                continue
+            self.dateFormat = date_format
+            return
+        raise ValueError('Unknown date format: {}'.format(day))
+
+    def parse_day(self, day):
+        if self.dateFormat is None:
+            self.detect_format(day)
+        try:
+            return datetime.datetime.strptime(day, self.dateFormat)
+        except ValueError:
+            # Format changed within the file
+            self.detect_format(day)
+            return datetime.datetime.strptime(day, self.dateFormat)
+
+    def parse_zone(self, zone):
+        # Minutes east of UTC of 'UTC+01', 'UTC-04:30' and the like, 0 for
+        # 'UTC' or anything else
+        match = self.ZONE.search(zone)
+        if match is None:
+            return 0
+        sign, hours, minutes = match.groups()
+        return (-1 if sign == '-' else 1) * (int(hours) * 60 + int(minutes or 0))
+
+    def decode(self, date):
+        day, _, time = date.rpartition(' at ')
+        clock, _, zone = time.partition(' ')
+        hour, _, minute = clock.lower().partition(':')
+        hour = int(hour)
+        if minute.endswith(('am', 'pm')):
+            hour = hour % 12 + (12 if minute.endswith('pm') else 0)
+            minute = minute[:-2]
+        if self.zones is not None:
+            self.zones.append(self.parse_zone(zone))
+        return self.parse_day(day) + self.MINUTES[hour * 60 + int(minute)]
+
+
+class MessageBatcher():
+    # Messages found by a parser, handed to on_batch every batch_size messages
+    # and when the parser is closed. Without on_batch they are kept in msgs.
+    def __init__(self, on_batch=None, batch_size=BATCH_SIZE, decoder=None):
         self.msgs = []
+        self.onBatch = on_batch
+        self.batchSize = batch_size
+        self.decoder = decoder or TimestampDecoder()
+
+    def handleNewMessage(self, date, user, message):
+        self.msgs.append(Message(sys.intern(user), message, self.decoder.decode(date)))
+        if self.onBatch is not None and len(self.msgs) >= self.batchSize:
+            self.onBatch(self.msgs)
+            self.msgs = []
+
+    def flushBatch(self):
+        if self.onBatch is not None and self.msgs:
+            self.onBatch(self.msgs)
+            self.msgs = []
+
+
+class ParseHTMLForData(MessageBatcher, HTMLParser):
+    def __init__(self, on_batch=None, batch_size=BATCH_SIZE, decoder=None):
+        HTMLParser.__init__(self)
+        MessageBatcher.__init__(self, on_batch, batch_size, decoder)
         self.isUser      = False
         self.isDate      = False
         self.isMessage   = False
@@ -131,8 +1811,14 @@ class ParseHTMLForData(HTMLParser):
         self.currentUser = ''
         self.currentMessage = ''
         self.currentDate = ''
+        self.title = ''
+
+        # Field that further text is appended to; text may arrive split
+        # over several handle_data calls when the file is fed in chunks
+        self.appendTo = None
 
     def handle_starttag(self, tag, attrs):
+        self.appendTo = None
         currentClass = ''
         attrs = dict(attrs)
 
@@ -151,27 +1837,36 @@ class ParseHTMLForData(HTMLParser):
         self.lastStartTag = tag
 
     def handle_data(self, data):
-        global conversationName
+        if self.appendTo is not None:
+            setattr(self, self.appendTo, getattr(self, self.appendTo) + data)
+            if self.appendTo == 'title':
+                self.conversationName = self.title[18:]
 
-        if self.isUser:
+        elif self.isUser:
             self.isUser = False
             self.currentUser = data
+            self.appendTo = 'currentUser'
 
         elif self.isDate:
             self.isDate = False
             self.currentDate = data
+            self.appendTo = 'currentDate'
 
         elif self.isMessage:
             self.isMessage = False
             self.endOfHeader = False
             self.goToAdd = True
             self.currentMessage = data
+            self.appendTo = 'currentMessage'
 
         elif self.isTitle:
             self.isTitle = False
+            self.title = data
             self.conversationName = data[18:]
+            self.appendTo = 'title'
 
     def handle_endtag(self, tag):
+        self.appendTo = None
         if tag == 'div' and self.lastEndTag == 'div':
             self.endOfHeader = True
         
@@ -181,6 +1876,7 @@ class ParseHTMLForData(HTMLParser):
 
         if self.goToAdd:
             self.handleNewMessage(self.currentDate, self.currentUser, self.currentMessage)
+            self.currentMessage = ''
             self.isMessage = False
             self.isDate = False
             self.isUser = False
@@ -188,20 +1884,79 @@ class ParseHTMLForData(HTMLParser):
             self.goToAdd = False
 
         self.lastEndTag = tag
- 
-    def handleNewMessage(self, date, user, message):
-        tmp = ''
-        msg = {}
-        try:
-            tmp = datetime.strptime(date, '%A, %d %B %Y at %H:%M %Z')
-        except ValueError as e:
-            date = date[:-3]
-            tmp = datetime.strptime(date, '%A, %d %B %Y at %H:%M %Z')
-        msg['user'] = user
-        msg['message'] = message
-        msg['date'] = tmp
 
-        self.msgs.append(msg)
+    def close(self):
+        HTMLParser.close(self)
+        self.flushBatch()
+
+
+class UnexpectedMarkup(ValueError):
+    pass
+
+
+class ScanHTMLForData(MessageBatcher):
+    # Fast path for the export markup, which is always
+    #   <div class="message"><div class="message_header"><span class="user">..</span>
+    #   <span class="meta">..</span></div></div><p>..</p>
+    # without whitespace in between. Gives the same messages as
+    # ParseHTMLForData and raises UnexpectedMarkup on anything else.
+    MESSAGE_START = '<div class="message">'
+    MESSAGE = re.compile('<div class="message"><div class="message_header"><span class="user">([^<]*)</span>'
+        '<span class="meta">([^<]*)</span></div></div><p>([^<]*)</p>')
+    TITLE = re.compile('<title>([^<]*)</title>')
+    TAIL = re.compile(r'\s*(</[a-z]+>\s*)*')
+
+    def __init__(self, on_batch=None, batch_size=BATCH_SIZE, decoder=None):
+        super(ScanHTMLForData, self).__init__(on_batch, batch_size, decoder)
+        self.rawdata = ''
+        self.inHeader = True
+
+    def feed(self, data):
+        self.rawdata += data
+        self.scan(False)
+
+    def close(self):
+        self.scan(True)
+        if not self.TAIL.fullmatch(self.rawdata):
+            raise UnexpectedMarkup('unexpected markup after the last message')
+        self.flushBatch()
+
+    def scan(self, final):
+        rawdata = self.rawdata
+        pos = 0
+        while True:
+            start = rawdata.find(self.MESSAGE_START, pos)
+            if start < 0:
+                break
+
+            if self.inHeader:
+                title = self.TITLE.search(rawdata, 0, start)
+                if title is None:
+                    raise UnexpectedMarkup('no <title> before the first message')
+                self.conversationName = html.unescape(title.group(1))[18:]
+                self.inHeader = False
+                pos = start
+            elif not rawdata[pos:start].isspace() and start != pos:
+                raise UnexpectedMarkup('unexpected markup between messages')
+
+            match = self.MESSAGE.match(rawdata, start)
+            if match is None:
+                if final or rawdata.find('</p>', start) >= 0:
+                    raise UnexpectedMarkup('unexpected message markup')
+                break
+            user, date, message = match.groups()
+            # HTMLParser reports no data for empty tags: a missing user is
+            # 'Deleted' and an empty message is skipped
+            if message:
+                self.handleNewMessage(html.unescape(date), html.unescape(user) or 'Deleted', html.unescape(message))
+            pos = match.end()
+
+        # Only the header or a message split between chunks should be left,
+        # anything else is the end of the file
+        self.rawdata = rawdata[pos:]
+        if len(self.rawdata) > CHUNK_SIZE and not self.inHeader and \
+                not self.rawdata.lstrip().startswith(self.MESSAGE_START):
+            raise UnexpectedMarkup('unexpected markup after the last message')
 
 
 class ParseHTMLForUsers(HTMLParser):
@@ -216,25 +1971,204 @@ class ParseHTMLForUsers(HTMLParser):
             raise StopIteration
 
 
-class ComputeCoolStuff():
-    def __init__(self, data):
+class QuantileSketch():
+    # Counts of non-negative whole numbers in buckets growing by a constant
+    # factor, so quantiles are within relative_error of the exact ones while
+    # memory grows with the log of the range of values, not their number.
+    # Zero has a bucket of its own.
+    def __init__(self, relative_error=0.02):
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.logGamma = math.log(self.gamma)
+        self.buckets = Counter()
+        self.count = 0
+
+    def keys(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        return np.where(values > 0, np.ceil(np.log(np.maximum(values, 1)) / self.logGamma) + 1, 0).astype(np.int64)
+
+    def add(self, values):
+        keys, counts = np.unique(self.keys(values), return_counts=True)
+        self.add_buckets(keys, counts)
+
+    def add_buckets(self, keys, counts):
+        for key, count in zip(keys.tolist(), counts.tolist()):
+            self.buckets[key] += count
+            self.count += count
+
+    def merge(self, other):
+        self.buckets.update(other.buckets)
+        self.count += other.count
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                return self.value(key)
+        return self.value(max(self.buckets))
+
+    def value(self, key):
+        # Bucket key covers (gamma^(key - 2), gamma^(key - 1)]
+        return 0 if key == 0 else 2 * self.gamma ** (key - 1) / (self.gamma + 1)
+
+
+class ExactCounts(QuantileSketch):
+    # QuantileSketch keeping every value, for whole numbers with few distinct
+    # values like messages per session, so quantiles are counts that occurred
+    def __init__(self):
+        self.buckets = Counter()
+        self.count = 0
+
+    def keys(self, values):
+        return np.asarray(values, dtype=np.int64)
+
+    def value(self, key):
+        return key
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return '-'
+    minutes = int(round(seconds / 60))
+    if minutes < 60:
+        return '{} min'.format(minutes)
+    if minutes < 24 * 60:
+        return '{}h {:02d}min'.format(minutes // 60, minutes % 60)
+    return '{}d {}h'.format(minutes // 1440, minutes % 1440 // 60)
+
+
+class ActivityPlot():
+    # Plots shared by ComputeCoolStuff and GlobalStats, which give a name
+    # and get_messages_every_5_minutes
+    def plot_set_params(self, xlabel, ylabel, title, ax=None):
+        ax = ax or plt.gca()
+        ax.set_xlabel(xlabel)
+        ax.set_ylabel(ylabel)
+        ax.set_title(title)
+        ax.tick_params(axis='x', labelrotation=30)
+        ax.legend()
+        ax.grid()
+
+    def plot_show(self):
+        plt.show()
+
+    def plot_daily_activity(self, frequency, ax=None):
+        arr = self.get_messages_every_5_minutes(frequency)
+        x_axis = [i[0] for i in arr]
+        y_axis = [i[1] for i in arr]
+
+        show = ax is None
+        if show:
+            fig, ax = plt.subplots()
+        ax.plot(x_axis, y_axis)
+        
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+        ax.figure.autofmt_xdate()
+
+        self.plot_set_params('Hour', '# Messages', 'Daily Messages per {} Minutes with {}'.format(frequency, self.name), ax)
+        if show:
+            self.plot_show()
+
+
+class ComputeCoolStuff(ActivityPlot):
+    def __init__(self, data, verbose=True):
         self.messages = data['messages']
+        if not isinstance(self.messages, MessageColumns):
+            self.messages = MessageColumns.from_messages(self.messages)
         self.name = data['name']
         self.totalMessages = len(self.messages)
+
+        # Columns as arrays; everything below is binned from these once
+        self.dates = np.frombuffer(self.messages.dates, dtype=np.int64)
+        self.user_ids = np.frombuffer(self.messages.user_ids, dtype=np.uint16)
         self.users = list(self.get_num_of_messages_by_user().keys())
+        self.rollups = {}
         
-        print('\nConversation with {}'.format(self.name))
-        print('Total messages: {:,}\n'.format(self.totalMessages))
+        if verbose:
+            print('\nConversation with {}'.format(self.name))
+            print('Total messages: {:,}\n'.format(self.totalMessages))
+
+    @cached_property
+    def chronological(self):
+        # Index putting messages oldest first. Exports are newest first, but
+        # that is checked rather than relied on; messages out of order are
+        # sorted, keeping the saved order of messages sent the same minute
+        order = date_order(self.dates)
+        if order < 0:
+            return slice(None, None, -1)
+        if order > 0:
+            return slice(None)
+        return np.argsort(self.dates, kind='stable')
+
+    def ordered(self, column):
+        return column[self.chronological]
+
+    @cached_property
+    def user_counts(self):
+        return np.bincount(self.user_ids, minlength=len(self.messages.users))
+
+    @cached_property
+    def days(self):
+        return self.dates // 86400
+
+    @cached_property
+    def weeks(self):
+        # Weeks start on Sunday; day 0 (1970-01-01) was a Thursday
+        return self.days - (self.days + 4) % 7
+
+    @cached_property
+    def minutes(self):
+        return self.dates % 86400 // 60
+
+    def rollup(self, kind):
+        # Keys, user ids and counts of a rollup, read from the saved data when
+        # it has them and computed from the date column otherwise
+        if kind not in self.rollups:
+            if kind in self.messages.rollups:
+                table = np.frombuffer(self.messages.rollups[kind], dtype=np.int64).reshape(-1, 3)
+                self.rollups[kind] = (table[:, 0], table[:, 1], table[:, 2])
+            else:
+                keys = getattr(self, kind + 's') * 65536 + self.user_ids
+                keys, counts = np.unique(keys, return_counts=True)
+                self.rollups[kind] = (keys // 65536, keys % 65536, counts)
+        return self.rollups[kind]
+
+    def count_by_key(self, kind):
+        keys, user_ids, counts = self.rollup(kind)
+        keys, index = np.unique(keys, return_inverse=True)
+        return keys, np.bincount(index.ravel(), weights=counts, minlength=len(keys)).astype(np.int64)
+
+    @cached_property
+    def text_stats(self):
+        if self.messages.features:
+            return (np.frombuffer(self.messages.features['words'], dtype=np.uint32).astype(np.int64),
+                np.frombuffer(self.messages.features['letters'], dtype=np.uint32).astype(np.int64))
+
+        words = np.zeros(self.totalMessages, dtype=np.int64)
+        letters = np.zeros(self.totalMessages, dtype=np.int64)
+        for i in range(self.totalMessages):
+            text = self.messages.get_text(i)
+            words[i] = len(text.split())
+            letters[i] = count_letters(text)
+        return words, letters
+
+    def count_by_user(self, kind):
+        keys, user_ids, counts = self.rollup(kind)
+        users = {}
+        for user_id, user in enumerate(self.messages.users):
+            if user in self.users:
+                rows = user_ids == user_id
+                users[user] = dict(zip(keys[rows].tolist(), counts[rows].tolist()))
+        return users
 
     def get_num_of_messages_by_user(self):
         senders = {}
-        for message in self.messages:
-            sender = message['user']
-
-            if sender in senders:
-                senders[sender] += 1
-            else:
-                senders[sender] = 1
+        for user_id, user in enumerate(self.messages.users):
+            if self.user_counts[user_id]:
+                senders[user] = int(self.user_counts[user_id])
 
         return senders
     
@@ -246,158 +2180,85 @@ class ComputeCoolStuff():
             print('{:<18} - {:,} Messages({:.2f}%)'.format(sender[0], sender[1], (sender[1]/self.totalMessages)*100))
         print()
 
-    def week_range(self, date):
-        year, week, dow = date.isocalendar()
-        if dow == 7:
-            start_date = date
-        else:
-            start_date = date - datetime.timedelta(dow)
-            
-        end_date = start_date + datetime.timedelta(6)
-        return (start_date.date(), end_date.date())
-
     def messagesByWeek(self):
-        messages_by_week = {}
-        days_in_current_week = 0
-        is_first_day = True
-        for message in self.messages:
-            weekRange = self.week_range(message['date'])
-            current_date = message['date'].date()
-            current_week, end = weekRange
-
-            if not is_first_day:
-                if last_date != current_date:
-                    days_in_current_week += 1
-
-            if current_week in messages_by_week:
-                messages_by_week[current_week] += 1
-            else:
-                if not is_first_day:
-                    messages_by_week[last_week] = messages_by_week[last_week] / days_in_current_week
-                    days_in_current_week = 0
-                messages_by_week[current_week] = 1
-
-            last_date = message['date'].date()
-            last_week = current_week
-
-            is_first_day = False
-
-        # Set last week
-        if days_in_current_week > 0:
-            messages_by_week[last_week] = messages_by_week[last_week] / days_in_current_week
-
-        return messages_by_week  
+        # Average number of messages per active day of each week
+        weeks, counts = self.count_by_key('week')
+        active_days = self.count_by_key('day')[0]
+        active_days = np.bincount(np.searchsorted(weeks, active_days - (active_days + 4) % 7),
+            minlength=len(weeks))
+
+        return dict((day_to_date(week), count / days)
+            for week, count, days in zip(weeks.tolist(), counts.tolist(), active_days.tolist()))
         
     def messagesByDay(self):
-        days = {}
-        
-        for message in self.messages:
-            day = message['date'].date()
+        days, counts = self.count_by_key('day')
+        return dict((day_to_date(day), count) for day, count in zip(days.tolist(), counts.tolist()))
+
+    def count_words(self, stopwords=frozenset()):
+        words_count = Counter()
+        if self.messages.features:
+            # Words were folded and given ids at ingest
+            vocab = self.messages.features['vocab']
+            counts = np.bincount(np.frombuffer(self.messages.features['tokens'], dtype=np.uint32), minlength=len(vocab))
+            for token in np.flatnonzero(counts).tolist():
+                words_count[vocab[token]] = int(counts[token])
+        else:
+            for i in range(self.totalMessages):
+                # Fold all long enough words of a message in one translate call
+                words = [word for word in self.messages.get_text(i).split() if len(word) > MIN_WORD_LENGTH]
+                if words:
+                    words_count.update('\n'.join(words).lower().translate(WORD_TABLE).split('\n'))
 
-            if day in days:
-                days[day] += 1
-            else:
-                days[day] = 1
-        return days
-
-    def getAllWords(self, n):
-        min_length = 3
-        all_words = []
-        words_count = {}
-        for message in self.messages:
-            words = message['message'].split()
-            words = [w for w in words if len(w) > min_length]
-            words = [w.lower() for w in words]
-            words = [re.sub('[ ,.]','', w) for w in words]
-            words = [re.sub('ą','a', w) for w in words]
-            words = [re.sub('ę','e', w) for w in words]
-            words = [re.sub('ć','c', w) for w in words]
-            words = [re.sub('ó','o', w) for w in words]
-            words = [re.sub('ń','n', w) for w in words]
-            words = [re.sub('ż','z', w) for w in words]
-            words = [re.sub('ź','z', w) for w in words]
-            words = [re.sub('ś','s', w) for w in words]
-            words = [re.sub('ł','l', w) for w in words]
-            
-            for word in words:
-                all_words.append(word)
-            
-        for word in all_words:
-            if word in words_count:
-                words_count[word] += 1
-            else:
-                words_count[word] = 1
-        
-        sorted_words = sorted(words_count.items(), key=lambda x:x[1])
+        for word in stopwords & words_count.keys():
+            del words_count[word]
+        return words_count
+
+    def top_words(self, n, stopwords=frozenset()):
+        return heapq.nlargest(n, self.count_words(stopwords).items(), key=itemgetter(1))
+
+    def getAllWords(self, n, skip_stopwords=False):
+        stopwords = load_stopwords() if skip_stopwords else frozenset()
         print('Top {} Words:'.format(n))
-        for word in sorted_words[-n:]:
+        for word in reversed(self.top_words(n, stopwords)):
             if word[1] > 5: # If count bigger than 5
                 print('{:<8} - {}'.format(word[0], word[1]))
         print()
 
     def getMessagesByUserByWeek(self):
-        users = dict((user, {}) for user in self.users)
-        weeks = {}
-        for message in self.messages:
-            currentUser = message['user']
-            weekRange = self.week_range(message['date'])
-            start = weekRange[0]
-
-            if start in users[currentUser]:
-                users[currentUser][start] += 1
-            else:
-                users[currentUser][start] = 1
-
-        return users      
+        users = self.count_by_user('week')
+        return dict((user, dict((day_to_date(week), count) for week, count in weeks.items()))
+            for user, weeks in users.items())
         
     def getMessagesByUserByDay(self):
-        users = dict((user, {}) for user in self.users)
-        weeks = {}
-        for message in self.messages:
-            currentUser = message['user']
-            day = message['date'].date()
-
-            if day in users[currentUser]:
-                users[currentUser][day] += 1
-            else:
-                users[currentUser][day] = 1
-                
-            
-        return users
+        users = self.count_by_user('day')
+        return dict((user, dict((day_to_date(day), count) for day, count in days.items()))
+            for user, days in users.items())
 
-    def plot(self, x_axis, y_axis, label):
-        plt.plot(x_axis, y_axis, label=label)
-    
-    def plot_set_params(self, xlabel, ylabel, title):
-        plt.xlabel(xlabel)
-        plt.ylabel(ylabel)
-        plt.title(title)
-        plt.xticks(rotation=30)
-        plt.legend()
-        plt.grid()
+    # Plots go to the current pyplot axes unless given an ax, which is how
+    # batch reports draw on a reused Agg figure
 
-    def plot_show(self):
-        plt.show()
-
-    def plot_messages_by_user_by_week(self):
+    def plot(self, x_axis, y_axis, label, ax=None):
+        (ax or plt.gca()).plot(x_axis, y_axis, label=label)
+    
+    def plot_messages_by_user_by_week(self, ax=None):
         users = self.getMessagesByUserByWeek()
     
         for user in users:
             x_axis = list(users[user].keys())
             y_axis = list(users[user].values())
-            self.plot(x_axis, y_axis, label=user)
+            self.plot(x_axis, y_axis, label=user, ax=ax)
 
-        self.plot_set_params('Weeks', '# Messages', "Number of Messages by Week by User")
+        self.plot_set_params('Weeks', '# Messages', "Number of Messages by Week by User", ax)
 
-    def plot_messages_by_week(self):
+    def plot_messages_by_week(self, ax=None):
         weeks = self.messagesByWeek()
         x_axis = list(weeks.keys())
         y_axis = list(weeks.values())
-        self.plot(x_axis, y_axis, self.name)
+        self.plot(x_axis, y_axis, self.name, ax)
 
-        self.plot_set_params('Weeks', '# Messages', "Average Number of Messages by Week by User")
+        self.plot_set_params('Weeks', '# Messages', "Average Number of Messages by Week by User", ax)
 
-    def plot_messages_by_user_by_day(self):
+    def plot_messages_by_user_by_day(self, ax=None):
         users = self.getMessagesByUserByDay()
         for user in users:
             temp = {k: v for k, v in users[user].items() if v < 50}
@@ -405,72 +2266,161 @@ class ComputeCoolStuff():
             x_axis = list(temp.keys())
             y_axis = list(temp.values())
 
-            self.plot(x_axis, y_axis, label=user)
+            self.plot(x_axis, y_axis, label=user, ax=ax)
         
-        self.plot_set_params('Days', '# Messages', "Number of Messages by Day by User")
+        self.plot_set_params('Days', '# Messages', "Number of Messages by Day by User", ax)
 
-    def compute_breaks(self):
+    def get_breaks(self):
         max_difference = 10
         longest_break = 0
         longest_streak = 0
         longest_streak_start = ''
-        start_streak = ''
-        end_streak = ''
+        num_breaks = 0
 
         started_by_user = dict((user, 0) for user in self.users)
         ended_by_user = dict((user, 0) for user in self.users)
 
-        msgs = self.messages
-        for i in range(len(msgs) - 1):
-            msg1 = msgs[i]     # Newer message
-            msg2 = msgs[i + 1] # Older message
-
-            if start_streak == '':
-                start_streak = msg2
+        # Newest first, gaps are whole hours between neighbours
+        dates = self.ordered(self.dates)[::-1]
+        user_ids = self.ordered(self.user_ids)[::-1]
+        if len(dates) > 1:
+            hours_diff = (dates[:-1] - dates[1:]) // 3600
+            longest_break = max(longest_break, int(hours_diff.max()))
+
+            breaks = np.flatnonzero(hours_diff > max_difference)
+            num_breaks = len(breaks)
+            started = np.bincount(user_ids[breaks], minlength=len(self.messages.users))
+            ended = np.bincount(user_ids[breaks + 1], minlength=len(self.messages.users))
+            for user_id, user in enumerate(self.messages.users):
+                if user in started_by_user:
+                    started_by_user[user] = int(started[user_id])
+                    ended_by_user[user] = int(ended[user_id])
+
+            # A streak runs from the older message of one break to the older
+            # message of the next, the first one from the second message
+            if len(breaks):
+                start_streak = np.concatenate(([1], breaks[:-1] + 1))
+                streaks = ((dates[start_streak] - dates[breaks + 1]) // 3600) // 24
+                longest = int(np.argmax(streaks))
+                if streaks[longest] > longest_streak:
+                    longest_streak = int(streaks[longest])
+                    longest_streak_start = from_timestamp(int(dates[start_streak[longest]]))
+
+        return {
+            'breaks': num_breaks,
+            'started_by': started_by_user,
+            'ended_by': ended_by_user,
+            'longest_break': longest_break,
+            'longest_streak': longest_streak,
+            'longest_streak_start': longest_streak_start,
+        }
 
-            hours_diff = self.get_difference_in_hours(msg1['date'], msg2['date'])
-            
-            if longest_break < hours_diff:
-                longest_break = hours_diff
-
-            if hours_diff > max_difference:
-                started_by_user[msg1['user']] += 1
-                ended_by_user[msg2['user']] += 1
-                
-                end_streak = msg2
-                current_streak = self.get_difference_in_hours(start_streak['date'], end_streak['date']) // 24
-                if longest_streak < current_streak:
-                    longest_streak_start = start_streak['date']
-                    longest_streak = current_streak
-                
-                start_streak = msg2
-            
+    def get_sessions(self, max_difference=10, relative_error=0.02):
+        # One pass over the messages oldest first, PASS_SIZE at a time. A
+        # session ends at a break of more than max_difference hours, like in
+        # get_breaks. A reply is a message following one of another user in
+        # the same session, and its latency the time between the two.
+        dates = self.ordered(self.dates)
+        user_ids = self.ordered(self.user_ids)
+        num_users = len(self.messages.users)
+        lengths = QuantileSketch(relative_error)
+        sizes = ExactCounts()
+        latencies = {}
+        replies = Counter()
+        sessions = 0
+        first = 0
+
+        for start in range(0, len(dates), PASS_SIZE):
+            # Every step starts a message early to see the gap before its first one
+            low = max(start - 1, 0)
+            chunk_dates = dates[low:start + PASS_SIZE]
+            chunk_users = user_ids[low:start + PASS_SIZE].astype(np.int64)
+            gaps = chunk_dates[1:] - chunk_dates[:-1]
+            within = gaps // 3600 <= max_difference
+
+            # Sessions ending in this step, from the first message of each
+            # to the last one before the next session's first
+            boundaries = np.flatnonzero(~within) + 1
+            if len(boundaries):
+                firsts = np.concatenate(([first - low], boundaries[:-1]))
+                lengths.add(chunk_dates[boundaries - 1] - np.asarray(dates[low + firsts]))
+                sizes.add(boundaries - firsts)
+                sessions += len(boundaries)
+                first = low + int(boundaries[-1])
+
+            reply = within & (chunk_users[1:] != chunk_users[:-1])
+            # Keyed by who replied, then to whom
+            pairs = chunk_users[1:][reply] * num_users + chunk_users[:-1][reply]
+            # Rows of pair and latency bucket, as buckets have no upper bound
+            keys = np.stack((pairs, lengths.keys(gaps[reply])), axis=1)
+            keys, counts = np.unique(keys, axis=0, return_counts=True)
+            for pair in np.unique(keys[:, 0]).tolist():
+                rows = keys[:, 0] == pair
+                latency = latencies.setdefault(pair, QuantileSketch(relative_error))
+                latency.add_buckets(keys[rows, 1], counts[rows])
+                replies[pair] += int(counts[rows].sum())
+
+        if len(dates):
+            lengths.add([dates[-1] - dates[first]])
+            sizes.add([len(dates) - first])
+            sessions += 1
+
+        users = self.messages.users
+        return {
+            'sessions': sessions,
+            'length': lengths,
+            'size': sizes,
+            'replies': dict(((users[pair // num_users], users[pair % num_users]), count)
+                for pair, count in replies.items()),
+            'latency': dict(((users[pair // num_users], users[pair % num_users]), latency)
+                for pair, latency in latencies.items()),
+        }
 
+    def compute_breaks(self, top=20):
+        breaks = self.get_breaks()
         print("Conversations started by:")
-        for entry in self.sort_dict(started_by_user):
+        for entry in self.sort_dict(breaks['started_by']):
             print('{:<9} - {}'.format(self.get_name(entry[0]), entry[1]))
         print("\nConversations ended by:")
-        for entry in self.sort_dict(ended_by_user):
+        for entry in self.sort_dict(breaks['ended_by']):
             print('{:<9} - {}'.format(self.get_name(entry[0]), entry[1]))
-        print("\nThe longest break was {} days :(".format(longest_break//24))
-        print("But your longest streak was {} days! It started on {}".format(longest_streak, longest_streak_start))
+        print("\nThe longest break was {} days :(".format(breaks['longest_break']//24))
+        print("But your longest streak was {} days! It started on {}".format(breaks['longest_streak'], breaks['longest_streak_start']))
+
+        sessions = self.get_sessions()
+        length, size = sessions['length'], sessions['size']
+        print("\nSessions without a break: {:,}".format(sessions['sessions']))
+        print("Session length: median {}, 90% {}, 99% {}".format(
+            *[format_duration(length.quantile(q)) for q in (0.5, 0.9, 0.99)]))
+        print("Messages per session: median {:.0f}, 90% {:.0f}, 99% {:.0f}".format(
+            *[size.quantile(q) or 0 for q in (0.5, 0.9, 0.99)]))
+
+        print("\nWho replies to whom:")
+        for (user, to), count in self.sort_dict(sessions['replies']):
+            if top == 0:
+                break
+            top -= 1
+            latency = sessions['latency'][(user, to)]
+            print('{:<9} -> {:<9} - {:,} replies, median {}, 90% {}, 99% {}'.format(
+                self.get_name(user), self.get_name(to), count,
+                *[format_duration(latency.quantile(q)) for q in (0.5, 0.9, 0.99)]))
+
+    def get_words_by_user(self):
+        words, letters = self.text_stats
+        total_words = np.bincount(self.user_ids, weights=words, minlength=len(self.messages.users))
+        total_letters = np.bincount(self.user_ids, weights=letters, minlength=len(self.messages.users))
+
+        users = {}
+        for user_id, user in enumerate(self.messages.users):
+            users[user] = {
+                'total_words': int(total_words[user_id]),
+                'total_letters': int(total_letters[user_id]),
+                'total_msgs': int(self.user_counts[user_id]),
+            }
+        return users
 
     def compute_total_words_by_user(self):
-        users = dict((user, {
-                'total_words': 0, 
-                'total_letters': 0, 
-                'total_msgs': 0,
-            }) for user in self.users)
-
-        for message in self.messages:
-            temp = re.sub('[ ,.:;]','', message['message'])
-            num_letters = len(temp)
-            num_words = len(message['message'].split())
-
-            user = message['user']
-            users[user]['total_letters'] += num_letters
-            users[user]['total_words'] += num_words
-            users[user]['total_msgs'] += 1
+        users = self.get_words_by_user()
         
         tmp = self.sort_dict(self.get_num_of_messages_by_user())
         for entry in tmp:
@@ -489,42 +2439,457 @@ class ComputeCoolStuff():
     def sort_dict(self, dictionary): 
         return reversed(sorted(dictionary.items(), key=lambda x:x[1]))
 
-    def get_difference_in_hours(self, date1, date2):
-        diff = date1 - date2
-        days, seconds = diff.days, diff.seconds
-        hours = days * 24 + seconds // 3600
-        return hours
-    
-    def plot_daily_activity(self, frequency):
-        arr = self.get_messages_every_5_minutes(self.messages, frequency)
-        x_axis = [i[0] for i in arr]
-        y_axis = [i[1] for i in arr]
+    def get_messages_every_5_minutes(self, frequency):
+        minutes, counts = self.count_by_key('minute')
+        return group_minutes(np.bincount(minutes, weights=counts, minlength=1440), frequency)
+
+
+def group_minutes(counts, frequency):
+    # Counts by minute of the day as (time, count) of every frequency minutes of each hour
+    minutes = np.arange(1440)
+    counts = np.bincount(minutes - minutes % 60 % frequency, weights=counts, minlength=1440)
+
+    intervals = []
+    for minute in np.flatnonzero(counts).tolist():
+        intervals.append((datetime.datetime(1900, 1, 1, minute // 60, minute % 60), int(counts[minute])))
+    return intervals
+
+
+def conversation_stats(filename, user=None, start=None, end=None):
+    # Aggregates of one conversation that GlobalStats adds up
+    analytics = ComputeCoolStuff(load_saved_file(saved_path(filename), start, end, user), verbose=False)
+
+    minutes, counts = analytics.count_by_key('minute')
+    breaks = analytics.get_breaks()
+    return {
+        'messages': analytics.get_num_of_messages_by_user(),
+        'words': analytics.get_words_by_user(),
+        'minutes': np.bincount(minutes, weights=counts, minlength=1440).astype(np.int64),
+        'breaks': breaks['breaks'],
+        'longest_break': breaks['longest_break'],
+        'started_by': breaks['started_by'],
+        'ended_by': breaks['ended_by'],
+        'events': profiler.collect() if profiler is not None else [],
+    }
+
+
+class GlobalStats(ActivityPlot):
+    # Archive-wide statistics merged from one conversation at a time, so
+    # memory does not depend on the size of the archive
+    def __init__(self, name='All Conversations'):
+        self.name = name
+        self.conversations = 0
+        self.messageCounts = Counter()
+        self.words = Counter()
+        self.letters = Counter()
+        self.minutes = np.zeros(1440, dtype=np.int64)
+        self.breaks = 0
+        self.longestBreak = 0
+        self.startedBy = Counter()
+        self.endedBy = Counter()
+
+    def merge(self, stats):
+        if not stats['messages']:
+            return
+        self.conversations += 1
+        self.messageCounts.update(stats['messages'])
+        for user, words in stats['words'].items():
+            self.words[user] += words['total_words']
+            self.letters[user] += words['total_letters']
+        self.minutes += stats['minutes']
+        self.breaks += stats['breaks']
+        self.longestBreak = max(self.longestBreak, stats['longest_break'])
+        self.startedBy.update(stats['started_by'])
+        self.endedBy.update(stats['ended_by'])
+
+    def get_messages_every_5_minutes(self, frequency):
+        return group_minutes(self.minutes, frequency)
+
+    def print_stats(self, top=20):
+        total = sum(self.messageCounts.values())
+        print('\n{}'.format(self.name))
+        print('Conversations: {:,}, Total messages: {:,}\n'.format(self.conversations, total))
 
-        fig, ax = plt.subplots()
-        ax.plot(x_axis, y_axis)
-        
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-        fig.autofmt_xdate()
-
-        self.plot_set_params('Hour', '# Messages', 'Daily Messages per {} Minutes with {}'.format(frequency, self.name))
-        self.plot_show()
-
-    def get_messages_every_5_minutes(self, messages, frequency):
-        count_by_interval = {}
-        intervals = {}
-        for msg in messages:
-            date = msg['date']
-            day = datetime.date(date.year, date.month, date.day)
-
-            minute = ((date.minute // frequency) * frequency)
-            hour = (date.hour)
-            entry = datetime.datetime.strptime('{} {}'.format(hour, minute), '%H %M')
-            if entry in intervals:
-                intervals[entry] += 1
+        print('User Stats:')
+        for user, count in self.messageCounts.most_common(top):
+            print('{:<18} - {:,} Messages({:.2f}%), Avg Words per Message: {:.2f}, Avg Letters per Word: {:.2f}'.format(
+                user, count, count / total * 100,
+                self.words[user] / count, self.letters[user] / max(self.words[user], 1)))
+
+        print('\nMessages by hour:')
+        hours = self.minutes.reshape(24, 60).sum(axis=1)
+        for hour, count in enumerate(hours.tolist()):
+            print('{:02d}:00 {:>10,} {}'.format(hour, count, '#' * int(50 * count / max(hours.max(), 1))))
+
+        print('\nBreaks of more than 10 hours: {:,}, the longest was {} days'.format(self.breaks, self.longestBreak // 24))
+        print('Conversations most often started by:')
+        for user, count in self.startedBy.most_common(5):
+            print('{:<18} - {:,}'.format(user, count))
+        print('Conversations most often ended by:')
+        for user, count in self.endedBy.most_common(5):
+            print('{:<18} - {:,}'.format(user, count))
+        print()
+
+
+# Charts of a batch report: file suffix and the ComputeCoolStuff plot drawing it
+REPORT_CHARTS = (
+    ('by_user_by_week', lambda analytics, ax: analytics.plot_messages_by_user_by_week(ax)),
+    ('by_week', lambda analytics, ax: analytics.plot_messages_by_week(ax)),
+    ('activity', lambda analytics, ax: analytics.plot_daily_activity(10, ax)),
+)
+
+
+@lru_cache(maxsize=None)
+def report_figure():
+    # One Agg figure per process, cleared between charts; no display needed
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    figure = Figure(figsize=(12, 6))
+    FigureCanvasAgg(figure)
+    return figure
+
+
+def render_report(filename, out, image_format='png'):
+    start = time.perf_counter()
+    analytics = ComputeCoolStuff(load_saved_file(saved_path(filename)), verbose=False)
+    entry = {
+        'filename': filename,
+        'name': analytics.name,
+        'messages': analytics.totalMessages,
+        'load_seconds': time.perf_counter() - start,
+        'charts': [],
+    }
+
+    figure = report_figure()
+    for chart, draw in REPORT_CHARTS:
+        start = time.perf_counter()
+        figure.clf()
+        ax = figure.add_subplot(111)
+        draw(analytics, ax)
+        path = '{}_{}.{}'.format(filename[:-5], chart, image_format)
+        figure.savefig(os.path.join(out, path), format=image_format)
+        entry['charts'].append({
+            'chart': chart,
+            'path': path,
+            'seconds': time.perf_counter() - start,
+        })
+    # Workers hand their profile back with the entry
+    entry['events'] = profiler.collect() if profiler is not None else []
+    return entry
+
+
+def select_conversations(patterns, catalog):
+    # Comma separated globs matched against file and conversation names
+    if patterns is True or patterns == 'all':
+        return sorted(catalog)
+    selected = []
+    for pattern in patterns.split(','):
+        for filename in sorted(catalog):
+            if filename not in selected and (fnmatch.fnmatch(filename, pattern) or fnmatch.fnmatch(catalog[filename]['name'], pattern)):
+                selected.append(filename)
+    return selected
+
+
+def render_reports(patterns, out='./report', image_format='png', workers=1):
+    catalog = load_catalog()
+    filenames = select_conversations(patterns, catalog)
+    os.makedirs(out, exist_ok=True)
+
+    start = time.perf_counter()
+    render = partial(render_report, out=out, image_format=image_format)
+    entries = []
+    if workers > 1:
+        with Pool(workers, *worker_profiler_args()) as pool:
+            for entry in pool.imap_unordered(render, filenames):
+                events = entry.pop('events')
+                if profiler is not None:
+                    profiler.events.extend(events)
+                entries.append(entry)
+                print('[{}/{}] Rendered {}'.format(len(entries), len(filenames), entry['filename']))
+    else:
+        for filename in filenames:
+            entries.append(render(filename))
+            entries[-1].pop('events')
+            print('[{}/{}] Rendered {}'.format(len(entries), len(filenames), filename))
+    total = time.perf_counter() - start
+
+    entries.sort(key=lambda x:x['messages'], reverse=True)
+    write_report_index(entries, out)
+
+    charts = [chart['seconds'] for entry in entries for chart in entry['charts']]
+    print('{} charts of {} conversations in {:.2f}s, {:.3f}s per chart on average'.format(
+        len(charts), len(entries), total, sum(charts) / max(len(charts), 1)))
+    for chart, draw in REPORT_CHARTS:
+        seconds = [x['seconds'] for entry in entries for x in entry['charts'] if x['chart'] == chart]
+        if seconds:
+            print('{:<16} avg {:.3f}s, max {:.3f}s'.format(chart, sum(seconds) / len(seconds), max(seconds)))
+
+
+def write_report_index(entries, out):
+    save_json(os.path.join(out, 'index.json'), entries)
+    with open(os.path.join(out, 'index.html'), 'w', encoding="utf8") as f:
+        f.write('<html><head><meta charset="utf-8"><title>Conversations</title></head><body>\n')
+        f.write('<table border="1"><tr><th>Conversation</th><th>Messages</th><th>Charts</th></tr>\n')
+        for entry in entries:
+            charts = ' '.join('<a href="{0}">{1}</a> ({2:.2f}s)'.format(
+                html.escape(chart['path']), chart['chart'], chart['seconds']) for chart in entry['charts'])
+            f.write('<tr><td>{}<br>{}</td><td>{:,}</td><td>{}</td></tr>\n'.format(
+                html.escape(entry['name']), entry['filename'], entry['messages'], charts))
+        f.write('</table></body></html>\n')
+
+
+def compute_global_stats(user=None, workers=1, start=None, end=None):
+    # Conversations the user never wrote in, or without messages in the
+    # date range, are skipped using the catalog
+    catalog = load_catalog()
+    filenames = [filename for filename in catalog
+        if (user is None or any(name.startswith(user) for name in catalog[filename]['users']))
+        and (start is None or catalog[filename]['last'] is None or catalog[filename]['last'] >= start)
+        and (end is None or catalog[filename]['first'] is None or catalog[filename]['first'] < end)]
+
+    stats = GlobalStats('All Conversations' if user is None else 'All Conversations of {}'.format(user))
+    if workers > 1:
+        with Pool(workers, *worker_profiler_args()) as pool:
+            for conversation in pool.imap_unordered(partial(conversation_stats, user=user, start=start, end=end), filenames):
+                if profiler is not None:
+                    profiler.events.extend(conversation['events'])
+                stats.merge(conversation)
+    else:
+        for filename in filenames:
+            stats.merge(conversation_stats(filename, user, start, end))
+    return stats
+
+
+def session_summary(analytics):
+    # get_sessions with quantiles (0.5, 0.9, 0.99) instead of sketches
+    sessions = analytics.get_sessions()
+    quantiles = lambda sketch: [sketch.quantile(q) for q in (0.5, 0.9, 0.99)]
+    return {
+        'sessions': sessions['sessions'],
+        'length': quantiles(sessions['length']),
+        'size': quantiles(sessions['size']),
+        # Replies from one user to messages of another
+        'replies': [{'from': user, 'to': to, 'replies': count, 'latency': quantiles(sessions['latency'][(user, to)])}
+            for (user, to), count in analytics.sort_dict(sessions['replies'])],
+    }
+
+
+# Queries of -serve by name, run on a conversation's ComputeCoolStuff with the request
+SERVER_QUERIES = {
+    'stats': lambda analytics, request: analytics.get_num_of_messages_by_user(),
+    'wordstats': lambda analytics, request: analytics.get_words_by_user(),
+    'topwords': lambda analytics, request: analytics.top_words(int(request.get('n', 15)),
+        load_stopwords() if request.get('stopwords') else frozenset()),
+    'breaks': lambda analytics, request: analytics.get_breaks(),
+    'sessions': lambda analytics, request: session_summary(analytics),
+    'week': lambda analytics, request: analytics.messagesByWeek(),
+    'day': lambda analytics, request: analytics.messagesByDay(),
+    'user_week': lambda analytics, request: analytics.getMessagesByUserByWeek(),
+    'user_day': lambda analytics, request: analytics.getMessagesByUserByDay(),
+    'activity': lambda analytics, request: [(minute.strftime('%H:%M'), count)
+        for minute, count in analytics.get_messages_every_5_minutes(int(request.get('frequency', 10)))],
+}
+
+
+def to_json(value):
+    # Results with dates, also as keys, and NumPy numbers as plain JSON
+    if isinstance(value, dict):
+        return dict((key.isoformat() if isinstance(key, datetime.date) else key, to_json(item))
+            for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [to_json(item) for item in value]
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def held_bytes(values):
+    # Memory held by values: numpy and array columns, buffers and strings,
+    # found through containers and object attributes, with views of one
+    # buffer counted once. Memory-mapped columns are left out, their pages
+    # belong to the page cache, which drops them by itself.
+    seen = set()
+    total = 0
+    stack = list(values)
+    while stack:
+        value = stack.pop()
+        while True:
+            if isinstance(value, np.ndarray) and value.base is not None:
+                value = value.base
+            elif isinstance(value, memoryview):
+                value = value.obj
             else:
-                intervals[entry] = 1
+                break
+        if id(value) in seen or isinstance(value, mmap.mmap):
+            continue
+        seen.add(id(value))
+        if isinstance(value, dict):
+            total += sys.getsizeof(value)
+            stack.extend(value.keys())
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            total += sys.getsizeof(value)
+            stack.extend(value)
+        elif isinstance(value, np.ndarray):
+            total += value.nbytes
+        elif isinstance(value, (bytes, bytearray, array)):
+            total += memoryview(value).nbytes
+        elif isinstance(value, str):
+            total += sys.getsizeof(value)
+        elif hasattr(value, '__dict__') and not callable(value):
+            stack.extend(vars(value).values())
+    return total
+
+
+class ConversationCache():
+    # Conversations loaded by -serve and the JSON of every query run on
+    # them, dropping the least recently used once over max_bytes. An entry
+    # is sized by held_bytes of its columns, the arrays its analytics keep
+    # and its results, measured again whenever a query adds to them.
+    # Entries are keyed by their saved directory, which is replaced when
+    # written again, so a changed conversation is loaded anew.
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.catalog = (None, {})
+
+    def find(self, conversation):
+        # File name or beginning of a conversation name, like -load and -find
+        stat = os.stat('./saved/catalog.json')
+        with self.lock:
+            if self.catalog[0] != (stat.st_ino, stat.st_mtime_ns):
+                self.catalog = ((stat.st_ino, stat.st_mtime_ns), load_catalog())
+            catalog = self.catalog[1]
+        if conversation in catalog:
+            return conversation
+        for filename in sorted(catalog):
+            if catalog[filename]['name'].startswith(conversation):
+                return filename
+        raise ValueError('Could not find conversation {}'.format(conversation))
+
+    def get(self, filename, start=None, end=None, user=None):
+        stat = os.stat(saved_path(filename))
+        version = (stat.st_ino, stat.st_mtime_ns)
+        key = (filename, start, end, user)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['version'] == version:
+                self.entries.move_to_end(key)
+                return entry
+
+        # Loaded without the lock, other clients are served meanwhile
+        data = load_saved_file(saved_path(filename), start, end, user)
+        entry = {
+            'version': version,
+            'analytics': ComputeCoolStuff(data, verbose=False),
+            'results': {},
+        }
+        entry['bytes'] = held_bytes([entry['analytics'], entry['results']])
+        with self.lock:
+            if key in self.entries:
+                self.size -= self.entries.pop(key)['bytes']
+            self.entries[key] = entry
+            self.size += entry['bytes']
+            self.evict()
+        return entry
+
+    def evict(self):
+        # Drops the least recently used entries, keeping the newest one
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            self.size -= self.entries.popitem(last=False)[1]['bytes']
+
+    def query(self, request):
+        # JSON of a query's result, computed once per conversation and arguments
+        if request.get('query') == 'list':
+            return json.dumps(load_catalog()).encode('utf8')
+        if request.get('query') == 'status':
+            with self.lock:
+                return json.dumps({'conversations': len(self.entries), 'bytes': self.size,
+                    'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}).encode('utf8')
+        if request.get('query') not in SERVER_QUERIES:
+            raise ValueError('Unknown query {}, use one of: list, status, {}'.format(
+                request.get('query'), ', '.join(SERVER_QUERIES)))
+
+        # -to is inclusive like on the command line
+        start = parse_date(request['from']) if request.get('from') else None
+        end = parse_date(request['to']) + 86400 if request.get('to') else None
+        if not request.get('conversation'):
+            raise ValueError('conversation is required')
+        key = (self.find(request['conversation']), start, end, request.get('user'))
+        entry = self.get(*key)
+        arguments = json.dumps(request, sort_keys=True)
+        with self.lock:
+            result = entry['results'].get(arguments)
+            if result is not None:
+                self.hits += 1
+                return result
+            self.misses += 1
+
+        result = json.dumps(to_json(SERVER_QUERIES[request['query']](entry['analytics'], request))).encode('utf8')
+        with self.lock:
+            # The query may also have left arrays cached on the analytics
+            entry['results'][arguments] = result
+            grown = held_bytes([entry['analytics'], entry['results']]) - entry['bytes']
+            entry['bytes'] += grown
+            if self.entries.get(key) is entry:
+                self.size += grown
+                self.evict()
+        return result
+
+
+def serve_client(connection, cache):
+    # Answers requests of one client, a JSON object per line, with a line
+    # of {"result": ...} or {"error": ...} each
+    with connection, connection.makefile('rb') as requests:
+        for line in requests:
+            try:
+                response = b'{"result": ' + cache.query(json.loads(line)) + b'}\n'
+            except Exception as e:
+                # A bad query must not take down the server
+                response = json.dumps({'error': str(e)}).encode('utf8') + b'\n'
+            try:
+                connection.sendall(response)
+            except OSError:
+                break
+
+
+def serve(port=SERVE_PORT, workers=SERVE_THREADS, cache_mb=SERVE_CACHE_MB):
+    cache = ConversationCache(cache_mb * 1024 * 1024)
+    load_catalog()
+    connections = set()
+    with socket.create_server(('127.0.0.1', port)) as server, ThreadPoolExecutor(workers) as pool:
+        print('Serving on 127.0.0.1:{} with {} threads, Ctrl+C to stop'.format(port, workers))
+        try:
+            while True:
+                connection, address = server.accept()
+                connections.add(connection)
+                pool.submit(serve_client, connection, cache).add_done_callback(
+                    lambda future, connection=connection: connections.discard(connection))
+        except KeyboardInterrupt:
+            # Unblocks threads waiting on clients, so the pool can shut down
+            for connection in list(connections):
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            pool.shutdown(cancel_futures=True)
+
 
-        return sorted(intervals.items(), key=lambda x:x[0])
+def query_server(request, port=SERVE_PORT):
+    # Sends one request to a running -serve and returns its result
+    with socket.create_connection(('127.0.0.1', port)) as connection:
+        connection.sendall(json.dumps(request).encode('utf8') + b'\n')
+        with connection.makefile('rb') as responses:
+            response = json.loads(responses.readline())
+    if 'error' in response:
+        raise ValueError(response['error'])
+    return response['result']
 
 
 def getopts(argv):
@@ -541,49 +2906,133 @@ def getopts(argv):
     return opts
 
 
+def get_workers(args, default=1, bare=None):
+    # -j <n>, or -j alone for bare if given, else one per core
+    workers = args.get('-j', default)
+    if workers is True:
+        workers = bare or os.cpu_count()
+    return int(workers)
+
+
 if __name__ == "__main__":
     args = getopts(sys.argv)
 
+    # -profile-mem also traces peak allocations, at a large cost in speed
+    if '-profile' in args or '-profile-mem' in args:
+        start_profiler(memory='-profile-mem' in args)
+        atexit.register(profiler.print_summary)
+        path = args.get('-profile', args.get('-profile-mem'))
+        if path is not True:
+            atexit.register(profiler.save, path)
+
     if '-h' in args:
-        print('\nusage: [-A] parse all .html files\n')
+        print('\nusage: [-A] parse all .html files')
+        print('       [-j <workers>] parse files with a pool of worker processes')
+        print('       [-fast] parse with the fast scanner, falling back to HTMLParser on unknown markup')
+        print('       [-pipeline [<read>[,<write>]]] read ahead and write in threads while parsing, with')
+        print('                 queues of that many chunks and batches (4), and show how busy each was')
+        print('       [-migrate] convert conversations saved as pickles to the current format')
+        print('       [-merge <dirs>] merge the conversations of several exports (comma separated),')
+        print('                 dropping messages found in more than one, with [-j <workers>] and [-fast]')
+        print('       [-compress [fast|high|none]] store saved conversations compressed with zlib (fast)')
+        print('                 or lzma (high), or uncompressed, and show the compression ratio')
+        print('       [-profile [<file>]] time every stage of every file and print a summary at exit,')
+        print('                 optionally saving a Chrome trace with the summary as JSON to file')
+        print('       [-profile-mem [<file>]] -profile with peak allocations traced, which is much slower\n')
         print('       List items:')
         print('       [-files] list all .html files with conversation, size and path')
-        print('       [-list] list all conversations with number of messages\n')
+        print('       [-list] list all conversations with number of messages')
+        print('       [-search <words>] find messages containing all the words in every conversation,')
+        print('                         optionally [-user <name>] [-from <YYYY-MM-DD>] [-to <YYYY-MM-DD>] [-limit <n>]\n')
         print('       Run algorithms on specific items:')
         print('       [-load <filename>] parse and load specific file')
-        print('       [-find <conversation name>] find specific parsed conversation\n')
+        print('       [-find <conversation name>] find specific parsed conversation')
+        print('       optionally only messages [-from <YYYY-MM-DD>] [-to <YYYY-MM-DD>] by [-user <name>],')
+        print('       reading only the saved partitions holding them\n')
         print('       Algorithms:')
         print('       [-breaks] Computes breaks of >8h you had in conversation')
+        print('                 with session lengths and who replies to whom how fast')
         print('       [-wordstats] Shows how many words users wrote')
         print('       [-topwords] Shows top words in conversation')
+        print('       [-stopwords] Leaves common Polish words out of -topwords')
         print('       [-stats] Shows distribution of messages sent')
         print('       [-activity] Shows activity in conversation from beginning')
-        print('       [-plot] Shows messages sent by users by week')
+        print('       [-plot] Shows messages sent by users by week\n')
+        print('       Across all conversations:')
+        print('       [-global] Shows message, word, hour of day and break stats of all conversations,')
+        print('                 optionally only of [-user <name>] [-from <YYYY-MM-DD>] [-to <YYYY-MM-DD>],')
+        print('                 with [-j <workers>] and [-activity]')
+        print('       [-report [<names>]] Saves charts of all or the given conversations (comma separated,')
+        print('                 wildcards allowed) with an index.html to [-out <dir>] as [-format png|svg],')
+        print('                 with [-j <workers>]; no display needed\n')
+        print('       Query server:')
+        print('       [-serve [<port>]] answer JSON queries on 127.0.0.1 ({}) with [-j <threads>] ({}), keeping'.format(SERVE_PORT, SERVE_THREADS))
+        print('                 conversations and results in a cache of [-cache <MB>] ({})'.format(SERVE_CACHE_MB))
+        print('       [-query <json>] send a query to a server on [-port <port>] and print the result, like')
+        print('                 \'{"query": "topwords", "conversation": "0.html", "from": "2020-01-01"}\'')
+
+    # -compress without a codec picks the fast one, 'none' stores uncompressed.
+    # Without it conversations saved again keep their codec.
+    codec = args.get('-compress', KEEP_CODEC)
+    if codec is True:
+        codec = 'fast'
+    elif codec == 'none':
+        codec = None
+    elif '-compress' in args and codec not in CODECS:
+        print('Unknown codec {}, use one of: {}, none'.format(codec, ', '.join(CODECS)))
+        sys.exit(1)
+
+    # -pipeline takes queue depths for chunks read ahead and batches to write
+    depth = args.get('-pipeline')
+    if depth is True:
+        depth = (4, 4)
+    elif depth is not None:
+        depth = tuple(int(x) for x in (depth + ',' + depth).split(',')[:2])
+
+    workers = get_workers(args)
 
     if '-A' in args:
         print('Parsing ALL the files! This might take a while...')
-        parse_all_files()
+        parse_all_files(workers, '-fast' in args, codec, depth)
     
+    if '-migrate' in args:
+        migrate_saved_files(codec)
+
+    if '-merge' in args:
+        merge_archives(args['-merge'].split(','), workers, '-fast' in args, codec)
+
+    if '-compress' in args:
+        compress_saved_files(codec)
+
     if '-list' in args:
-        analyze_all_files(load_all_saved_files())
+        analyze_all_files(load_catalog())
+
+    # -to is inclusive, so ranges go up to the end of that day
+    user = args.get('-user')
+    start = parse_date(args['-from']) if '-from' in args else None
+    end = parse_date(args['-to']) + 86400 if '-to' in args else None
+
+    if '-search' in args:
+        results = search_messages(args['-search'], user=user, start=start, end=end,
+            limit=int(args.get('-limit', 50)))
+        print_search_results(results)
 
     if '-files' in args:
         print_listed_files(list_all_files())
     elif '-find' in args or '-load' in args:
         if '-find' in args:
             if (type(args['-find']) != bool):
-                data = find_file_by_conversation_name(args['-find'])
+                data = find_file_by_conversation_name(args['-find'], start, end, user)
             else:
                 print('Enter a name to find')
 
         if '-load' in args:
             filename = args['-load']
             print("Opening {}/{}".format('./messages', filename))
-            parse_file(filename)
+            parse_changed_files([filename], fast='-fast' in args, codec=codec, depth=depth)
 
-            with open ("./saved/{}_data.pickle".format(filename[:-5]), 'rb') as fp:
-                print('Loading {}...'.format(filename))
-                data = pickle.load(fp)
+            print('Loading {}...'.format(filename))
+            data = load_saved_file(saved_path(filename), start, end, user)
 
         analytics = ComputeCoolStuff(data)
 
@@ -594,7 +3043,7 @@ if __name__ == "__main__":
             analytics.compute_total_words_by_user()
 
         if '-topwords' in args:
-            analytics.getAllWords(15)
+            analytics.getAllWords(15, '-stopwords' in args)
 
         if '-stats' in args:
             analytics.printUserStats()
@@ -611,12 +3060,11 @@ if __name__ == "__main__":
         analytics = {}
         for filename in args['-compare']:
             if filename.endswith('.html'):
-                with open ("./saved/{}_data.pickle".format(filename[:-5]), 'rb') as fp:
-                    print('Loading {}...'.format(filename))
-                    data = pickle.load(fp)
-                    analytics[data['name']] = ComputeCoolStuff(data)
+                print('Loading {}...'.format(filename))
+                data = load_saved_file(saved_path(filename), start, end, user)
+                analytics[data['name']] = ComputeCoolStuff(data)
             else:
-                data = find_file_by_conversation_name(filename)
+                data = find_file_by_conversation_name(filename, start, end, user)
                 analytics[data['name']] = ComputeCoolStuff(data)
 
         for username in analytics:
@@ -624,16 +3072,27 @@ if __name__ == "__main__":
             
         plt.show()
         
-    if '-test' in args:
-        all_messages = []
-        tmp = load_all_saved_files()
-        for x in tmp:
-            for msg in tmp[x]['messages']:
-                if msg['user'] == 'Alex Niznik':
-                    all_messages.append(msg)
-        data = { 
-            'name': 'All Conversations',
-            'messages': all_messages
-        }
-        analytics = ComputeCoolStuff(data)
-        analytics.plot_daily_activity(10)
+    if '-report' in args:
+        render_reports(args['-report'], args.get('-out', './report'), args.get('-format', 'png'), workers)
+
+    if '-global' in args:
+        stats = compute_global_stats(user, workers, start, end)
+        stats.print_stats()
+        if '-activity' in args:
+            stats.plot_daily_activity(10)
+
+    if '-query' in args:
+        try:
+            result = query_server(json.loads(args['-query']), int(args.get('-port', SERVE_PORT)))
+        except ConnectionRefusedError:
+            print('No server running on port {}, start one with -serve'.format(args.get('-port', SERVE_PORT)))
+            sys.exit(1)
+        except ValueError as e:
+            print(e)
+            sys.exit(1)
+        print(json.dumps(result, indent=2, ensure_ascii=False))
+
+    if '-serve' in args:
+        port = args['-serve']
+        serve(SERVE_PORT if port is True else int(port), get_workers(args, SERVE_THREADS, SERVE_THREADS),
+            int(args.get('-cache', SERVE_CACHE_MB)))
@@ -0,0 +1,66 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import parse_with, write_conversation
+from parser import CHUNK_SIZE, ParseHTMLForData, ScanHTMLForData, UnexpectedMarkup
+
+# The fast scanner of -fast, with its HTMLParser fallback, must give exactly
+# what HTMLParser gives, however the file is split into chunks
+CHUNK_SIZES = (1 << 30, CHUNK_SIZE, 31)
+
+
+def edge_cases():
+    # Markup the scanner has to agree with HTMLParser on, and some it has to give up on
+    header = ('<html><head><title>Conversation with Tom &amp; Jerry</title></head><body>'
+              '<div class="thread">Conversation with Tom &amp; Jerry<br>Participants: Tom, Jerry')
+    message = ('<div class="message"><div class="message_header"><span class="user">{}</span>'
+               '<span class="meta">Friday, 24 November 2017 at 14:{:02d} UTC+01</span></div></div><p>{}</p>')
+    texts = ['plain', 'Tom &amp; Jerry &lt;3 &#x1F600;', 'line\nbreak', '   ', '', 'a' * 3 * CHUNK_SIZE,
+             'ąęćóńżźśł ĄĘĆÓŃŻŹŚŁ', '&gt;&gt; quoted', 'ok']
+    users = ['Tom', 'Jerry', '', 'Tom &amp; Jerry']
+    return {
+        'regular': header + ''.join(message.format(users[i % len(users)], i, text)
+            for i, text in enumerate(texts)) + '</div></body></html>',
+        'whitespace': header + '\n'.join(message.format('Tom', i, 'x') for i in range(3)) + '\n</div></body></html>\n',
+        'nested': header + message.format('Tom', 1, 'see <a href="x">link</a>') + '</div></body></html>',
+        'image': header + message.format('Tom', 1, '<img src="x.png">') + message.format('Jerry', 2, 'nice') + '</div></body></html>',
+        'two threads': header + message.format('Tom', 1, 'x') + '</div><div class="thread">Other' +
+            message.format('Jerry', 2, 'y') + '</div></body></html>',
+    }
+
+
+def scan(path, chunk_size):
+    # What -fast gives: the scanner, or HTMLParser once the scanner gives up
+    try:
+        return parse_with(ScanHTMLForData, path, chunk_size)
+    except UnexpectedMarkup:
+        return parse_with(ParseHTMLForData, path, chunk_size)
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('case', sorted(edge_cases()))
+def test_edge_cases(tmp_path, case, chunk_size):
+    path = tmp_path / 'case.html'
+    path.write_text(edge_cases()[case], encoding='utf8')
+    assert scan(path, chunk_size) == parse_with(ParseHTMLForData, path, 1 << 30)
+
+
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+@pytest.mark.parametrize('size, participants', [(1, 2), (100, 5), (5000, 8)])
+def test_synthetic_conversations(tmp_path, size, participants, chunk_size):
+    path = tmp_path / 'synthetic.html'
+    write_conversation(path, size, participants=participants, seed=size)
+    expected = parse_with(ParseHTMLForData, path, 1 << 30)
+    assert len(expected[1]) == size
+    assert scan(path, chunk_size) == expected
+
+
+def test_regular_markup_is_scanned(tmp_path):
+    # The fallback must not hide a scanner that gives up on every file
+    path = tmp_path / 'synthetic.html'
+    write_conversation(path, 100)
+    assert parse_with(ScanHTMLForData, path, 31) == parse_with(ParseHTMLForData, path, 1 << 30)
@@ -0,0 +1,137 @@
+import datetime
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import parse_with, write_conversation
+from parser import PARTITION_SIZE, ParseHTMLForData, compress_saved_files, load_json, load_manifest, \
+    load_saved_file, merge_archives, parse_all_files, saved_path, to_timestamp
+
+# Conversations saved by -A, -compress and -merge must load back as the
+# messages HTMLParser finds in the export
+
+MESSAGE_START = '<div class="message">'
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch):
+    # Saved data is always read and written relative to the working directory
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('messages')
+    return tmp_path
+
+
+def parsed(path):
+    return [(message['user'], message['message'], to_timestamp(message['date']))
+        for message in parse_with(ParseHTMLForData, path, 1 << 30)[1]]
+
+
+def saved(messages):
+    return [(message['user'], message['message'], to_timestamp(message['date'])) for message in messages]
+
+
+def columns(messages):
+    # Every column as bytes, text features included
+    values = [bytes(messages.dates), bytes(messages.user_ids), bytes(messages.offsets), bytes(messages.text)]
+    return values + [bytes(messages.features[column]) for column in ('words', 'letters', 'tokens', 'token_offsets')]
+
+
+def test_partitions_round_trip(archive):
+    # One conversation across the boundary of two partitions, in every codec
+    write_conversation('messages/big.html', PARTITION_SIZE + 1000, participants=3, text_length=2)
+    write_conversation('messages/small.html', 10, seed=1)
+    parse_all_files(fast=True)
+    expected = parsed('messages/big.html')
+
+    meta = load_json(os.path.join(saved_path('big.html'), 'meta.json'))
+    # Partitions record the row they end at
+    assert [partition['rows'] for partition in meta['partitions']] == [PARTITION_SIZE, PARTITION_SIZE + 1000]
+    uncompressed = load_saved_file(saved_path('big.html'))['messages']
+    assert saved(uncompressed) == expected
+    assert saved(load_saved_file(saved_path('small.html'))['messages']) == parsed('messages/small.html')
+
+    for codec in ('fast', 'high', None):
+        compress_saved_files(codec)
+        assert load_json(os.path.join(saved_path('big.html'), 'meta.json'))['codec'] == codec
+        messages = load_saved_file(saved_path('big.html'))['messages']
+        assert columns(messages) == columns(uncompressed)
+
+        # Filtered loads read only the partitions around the boundary;
+        # saved newest first, the second partition holds the oldest messages
+        start, end = expected[PARTITION_SIZE + 10][2], expected[PARTITION_SIZE - 10][2]
+        window = [message for message in expected if start <= message[2] < end]
+        assert saved(load_saved_file(saved_path('big.html'), start, end)['messages']) == window
+
+
+def split_export(path, roots, ranges):
+    # Exports of the conversation at path holding the given ranges of its messages
+    text = open(path, encoding='utf8').read()
+    parts = text.split(MESSAGE_START)
+    header, messages = parts[0], [MESSAGE_START + part for part in parts[1:]]
+    messages[-1] = messages[-1][:-len('</div></body></html>')]
+    for root, (start, stop) in zip(roots, ranges):
+        os.makedirs(root)
+        with open(os.path.join(root, os.path.basename(path)), 'w', encoding='utf8') as f:
+            f.write(header + ''.join(messages[start:stop]) + '</div></body></html>')
+
+
+def shift_zone(path, hours):
+    # The same export made in a time zone hours east of the original
+    def shifted(match):
+        date = datetime.datetime.strptime(match.group(1), '%A, %d %B %Y at %H:%M') + datetime.timedelta(hours=hours)
+        return '>{} UTC+0{}<'.format(date.strftime('%A, %d %B %Y at %H:%M'), int(match.group(2)) + hours)
+    text = open(path, encoding='utf8').read()
+    with open(path, 'w', encoding='utf8') as f:
+        f.write(re.sub('>([^<]* at [0-9:]+) UTC\\+0([0-9])<', shifted, text))
+
+
+@pytest.mark.parametrize('hours', [0, 1])
+def test_merge_drops_overlap(archive, hours):
+    write_conversation('full.html', 300, participants=3, text_length=2)
+    split_export('full.html', ['old', 'new'], [(120, 300), (0, 200)])
+    shift_zone('new/full.html', hours)
+    merge_archives(['old', 'new'])
+
+    expected = parsed('full.html')
+    merged = saved(load_saved_file(saved_path('full.html'))['messages'])
+    assert len(merged) == len(expected)
+    # Messages only in the shifted export keep its local time
+    shift = hours * 3600
+    assert merged == [(user, text, date + (shift if i < 120 else 0)) for i, (user, text, date) in enumerate(expected)]
+    assert load_manifest()['full.html'] == {'merged': ['old', 'new']}
+
+
+def test_unchanged_files_are_skipped(archive, capsys):
+    write_conversation('messages/a.html', 50)
+    write_conversation('messages/b.html', 50, seed=1)
+    parse_all_files()
+    hashes = dict((filename, entry['hash']) for filename, entry in load_manifest().items())
+
+    # A touched file is hashed again and skipped when its content is the same
+    os.utime('messages/a.html', ns=(0, 0))
+    capsys.readouterr()
+    parse_all_files()
+    assert '2 of 2 files unchanged, skipping' in capsys.readouterr().out
+    assert load_manifest()['a.html'] == {'size': os.path.getsize('messages/a.html'), 'mtime': 0, 'hash': hashes['a.html']}
+
+    # A changed one is parsed again
+    write_conversation('messages/b.html', 60, seed=2)
+    parse_all_files()
+    assert '1 of 2 files unchanged, skipping' in capsys.readouterr().out
+    assert load_manifest()['b.html']['hash'] != hashes['b.html']
+    assert saved(load_saved_file(saved_path('b.html'))['messages']) == parsed('messages/b.html')
+
+
+def test_codec_is_kept(archive):
+    # Parsing a changed file again without -compress keeps its codec
+    write_conversation('messages/a.html', 50)
+    parse_all_files()
+    compress_saved_files('high')
+    write_conversation('messages/a.html', 60, seed=1)
+    parse_all_files()
+    assert load_json(os.path.join(saved_path('a.html'), 'meta.json'))['codec'] == 'high'
+    assert saved(load_saved_file(saved_path('a.html'))['messages']) == parsed('messages/a.html')